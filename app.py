@@ -1,26 +1,39 @@
+import functools
 import os
 import threading
 import time
-import uuid
 from pathlib import Path
+from secrets import token_hex
 
 from dotenv import find_dotenv, load_dotenv
-from flask import Flask, Response, jsonify, render_template, request, session
+from flask import Flask, Response, abort, g, jsonify, render_template, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from itsdangerous import BadData, URLSafeSerializer
 
+import fast_json
 from assistant import WineAssistant
 from db import WineDB
-from perf_log import append_perf_log, get_perf_log_path, is_perf_log_enabled, tail_perf_log
+from perf_log import append_perf_log, elapsed_ms, get_perf_log_path, is_perf_log_enabled, tail_perf_log
 from public_records_db import PublicRecordError, PublicRecordsDB
+from session_store import SessionStore
 
 load_dotenv(find_dotenv())
 
 BASE_DIR = Path(__file__).resolve().parent
 DEFAULT_DB_PATH = (BASE_DIR.parent / "wine_product.sqlite").resolve()
 DEFAULT_USER_DB_PATH = (BASE_DIR.parent / "wine_social.sqlite").resolve()
+DEFAULT_SESSION_DB_PATH = (BASE_DIR.parent / "wine_sessions.sqlite").resolve()
 DB_PATH = Path(os.getenv("WINE_DB_PATH", str(DEFAULT_DB_PATH))).resolve()
 USER_DB_PATH = Path(os.getenv("WINE_USER_DB_PATH", str(DEFAULT_USER_DB_PATH))).resolve()
+SESSION_DB_PATH = Path(os.getenv("WINE_SESSION_DB_PATH", str(DEFAULT_SESSION_DB_PATH))).resolve()
 TABLE_NAME = os.getenv("WINE_TABLE", "wine_cards_wide")
 EXTERNAL_USER_ID_HEADER = os.getenv("EXTERNAL_USER_ID_HEADER", "X-External-User-Id")
+# Ключ заголовка в WSGI environ: читаем его напрямую, минуя обертку EnvironHeaders.
+EXTERNAL_USER_ID_ENVIRON_KEY = (
+    "HTTP_" + EXTERNAL_USER_ID_HEADER.strip().upper().replace("-", "_")
+    if EXTERNAL_USER_ID_HEADER.strip()
+    else ""
+)
 CAPABILITIES_FILE = BASE_DIR / "SYSTEM_CAPABILITIES.md"
 WELCOME_MESSAGE = (
     "В базе собраны карточки российских вин: название, производитель, регион, "
@@ -29,71 +42,198 @@ WELCOME_MESSAGE = (
     "Если хотите, в начале диалога представьтесь по имени, и я буду обращаться к вам по имени."
 )
 APP_DEBUG = str(os.getenv("WINE_APP_DEBUG", "0")).strip().lower() in {"1", "true", "yes", "on"}
+# Поля perf-метрик ассистента, которые попадают в лог /chat.
+PERF_LOG_FIELDS = (
+    "llm_rounds",
+    "selected_model",
+    "llm_input_chars_total",
+    "llm_output_chars_total",
+    "llm_prompt_tokens_total",
+    "llm_completion_tokens_total",
+    "llm_wait_ms_total",
+    "db_tool_calls",
+    "db_query_ms_total",
+    "web_tool_calls",
+    "web_query_ms_total",
+    "fallback_web_calls",
+    "fallback_web_ms_total",
+    "response_cache_hit",
+    "total_ms",
+)
+MAX_REQUEST_BYTES = 64 * 1024
+SID_COOKIE_NAME = "sid"
+SID_COOKIE_MAX_AGE = 30 * 24 * 3600
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs) -> str:
+        return fast_json.dumps(obj, default=self.default)
+
+    def loads(self, s, **kwargs):
+        return fast_json.loads(s)
+
 
 app = Flask(__name__)
+if fast_json.ORJSON_AVAILABLE:
+    app.json = FastJSONProvider(app)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "wine-chat2-dev-secret")
+# Werkzeug отклоняет тела больше лимита до чтения и разбора JSON.
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+# sid хранится в отдельной подписанной cookie, серверная flask.session не используется.
+_sid_signer = URLSafeSerializer(app.secret_key, salt="wine-chat2-sid")
+
+# БД и ассистент создаются лениво в каждом процессе: воркеры после fork
+# не должны наследовать открытые SQLite-соединения родителя.
+_INIT_LOCK = threading.RLock()
+_db: WineDB | None = None
+_records_db: PublicRecordsDB | None = None
+_assistant: WineAssistant | None = None
+_session_store: SessionStore | None = None
 
-db = WineDB(DB_PATH, table_name=TABLE_NAME)
-records_db = PublicRecordsDB(USER_DB_PATH, wine_db=db)
-assistant = WineAssistant(db=db, records_db=records_db)
-
-CHAT_STORE: dict[str, list[dict[str, str]]] = {}
-CONTEXT_STORE: dict[str, dict] = {}
-LOCK = threading.Lock()
 MAX_HISTORY_ITEMS = 24
+MAX_MESSAGE_CHARS = 4000
+SESSION_TTL_SEC = int(os.getenv("WINE_SESSION_TTL_SEC", "7200"))
+# Блокировки по сессиям: независимые sid не конкурируют за один общий mutex.
+_LOCK_STRIPES = 64
+_STRIPES = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+
+def _get_db() -> WineDB:
+    global _db
+    if _db is None:
+        with _INIT_LOCK:
+            if _db is None:
+                _db = WineDB(DB_PATH, table_name=TABLE_NAME)
+    return _db
+
+
+def _get_records_db() -> PublicRecordsDB:
+    global _records_db
+    if _records_db is None:
+        with _INIT_LOCK:
+            if _records_db is None:
+                _records_db = PublicRecordsDB(USER_DB_PATH, wine_db=_get_db())
+    return _records_db
+
+
+def _get_assistant() -> WineAssistant:
+    global _assistant
+    if _assistant is None:
+        with _INIT_LOCK:
+            if _assistant is None:
+                _assistant = WineAssistant(db=_get_db(), records_db=_get_records_db())
+    return _assistant
+
+
+def _get_session_store() -> SessionStore:
+    # SQLite — единственное хранилище истории и контекста: общее для всех воркеров
+    # и переживает перезапуск (WAL, выборки по индексу sid).
+    global _session_store
+    if _session_store is None:
+        with _INIT_LOCK:
+            if _session_store is None:
+                _session_store = SessionStore(
+                    SESSION_DB_PATH,
+                    max_history_items=MAX_HISTORY_ITEMS,
+                    ttl_sec=SESSION_TTL_SEC,
+                )
+    return _session_store
+
+
+def _lock_for(sid: str) -> threading.Lock:
+    return _STRIPES[hash(sid) & (_LOCK_STRIPES - 1)]
+
+
+def _new_context_state() -> dict:
+    return {
+        "last_wine_candidates": [],
+        "pending_record_action": None,
+    }
 
 
 def _session_id() -> str:
-    sid = session.get("sid")
-    if not sid:
-        sid = uuid.uuid4().hex
-        session["sid"] = sid
+    sid = g.get("sid")
+    if sid:
+        return sid
+
+    raw = request.cookies.get(SID_COOKIE_NAME)
+    if raw:
+        try:
+            sid = _sid_signer.loads(raw)
+        except BadData:
+            sid = None
+    if not isinstance(sid, str) or not sid:
+        sid = token_hex(16)
+        g.sid_is_new = True
+    g.sid = sid
     return sid
 
 
-def _get_history(sid: str) -> list[dict[str, str]]:
-    with LOCK:
-        return CHAT_STORE.setdefault(sid, [])
+@app.before_request
+def _reject_oversized_request() -> None:
+    if request.content_length is not None and request.content_length > MAX_REQUEST_BYTES:
+        abort(413)
 
 
-def _append_history(sid: str, role: str, content: str) -> None:
-    with LOCK:
-        items = CHAT_STORE.setdefault(sid, [])
-        items.append({"role": role, "content": content})
-        if len(items) > MAX_HISTORY_ITEMS:
-            CHAT_STORE[sid] = items[-MAX_HISTORY_ITEMS:]
+@app.errorhandler(413)
+def _request_too_large(_exc):
+    if request.path == "/chat":
+        return jsonify({"response": "Слишком длинный запрос.", "meta": {"sql": None, "rows": 0}}), 413
+    return jsonify({"ok": False, "error": "Слишком большой запрос."}), 413
 
 
-def _get_context_state(sid: str) -> dict:
-    with LOCK:
-        return CONTEXT_STORE.setdefault(
-            sid,
-            {
-                "last_wine_candidates": [],
-                "pending_record_action": None,
-            },
+@app.after_request
+def _set_sid_cookie(response: Response) -> Response:
+    if g.get("sid_is_new"):
+        response.set_cookie(
+            SID_COOKIE_NAME,
+            _sid_signer.dumps(g.sid),
+            max_age=SID_COOKIE_MAX_AGE,
+            httponly=True,
+            samesite="Lax",
         )
+    return response
+
+
+def _history_snapshot(sid: str) -> tuple[dict[str, str], ...]:
+    # История читается из SQLite на каждый запрос: кэш в памяти процесса расходился бы
+    # с репликами, записанными другими воркерами. dict-формат нужен только ассистенту.
+    return tuple(item.to_dict() for item in _get_session_store().get_history(sid))
+
+
+def _append_messages(sid: str, messages: list[tuple[str, str]]) -> None:
+    # Под блокировкой сессии: ходы одного sid попадают в SQLite в том порядке, в котором завершились.
+    with _lock_for(sid):
+        _get_session_store().append_messages(sid, messages)
+
+
+def _get_context_state(sid: str) -> dict:
+    # Как и история, контекст (кандидаты, ожидающее действие) всегда берется из SQLite:
+    # "лайкни первое" в другом воркере не должно разрешаться по устаревшему списку.
+    return _get_session_store().get_context(sid) or _new_context_state()
 
 
 def _update_context_state_from_meta(sid: str, meta: dict) -> dict:
-    with LOCK:
-        state = CONTEXT_STORE.setdefault(
-            sid,
-            {
-                "last_wine_candidates": [],
-                "pending_record_action": None,
-            },
-        )
+    # Чтение, изменение и запись контекста — под блокировкой сессии.
+    with _lock_for(sid):
+        state = _get_context_state(sid)
+        changed = False
         candidates = meta.get("wine_context_candidates")
         if isinstance(candidates, list) and candidates:
             state["last_wine_candidates"] = candidates[:30]
+            changed = True
 
         if meta.get("clear_pending_record_action"):
             state["pending_record_action"] = None
+            changed = True
 
         pending = meta.get("set_pending_record_action")
         if isinstance(pending, dict):
             state["pending_record_action"] = pending
+            changed = True
+
+        if changed:
+            _get_session_store().save_context(sid, state)
 
         return {
             "last_wine_candidates_count": len(state.get("last_wine_candidates") or []),
@@ -101,9 +241,36 @@ def _update_context_state_from_meta(sid: str, meta: dict) -> dict:
         }
 
 
+@functools.lru_cache(maxsize=1)
+def _capabilities_text() -> str:
+    # Ошибки чтения не кэшируются lru_cache и попадают в обработчик как раньше.
+    return CAPABILITIES_FILE.read_text(encoding="utf-8").strip()
+
+
+def _columns_count() -> int:
+    # Без своего кэша: get_columns уже кэширует схему по data_version файла каталога.
+    return len(_get_db().get_columns())
+
+
+def _json_payload() -> dict:
+    if not request.is_json:
+        return {}
+    body = request.get_data(cache=False)
+    if not body:
+        return {}
+    try:
+        payload = fast_json.loads(body)
+    except ValueError:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+
 def _resolve_external_user_id(payload: dict) -> str:
-    header_name = EXTERNAL_USER_ID_HEADER
-    header_value = str(request.headers.get(header_name, "")).strip() if header_name else ""
+    header_value = (
+        str(request.environ.get(EXTERNAL_USER_ID_ENVIRON_KEY, "")).strip()
+        if EXTERNAL_USER_ID_ENVIRON_KEY
+        else ""
+    )
     if header_value:
         return header_value
 
@@ -136,7 +303,7 @@ def index():
         "index.html",
         db_path=str(DB_PATH),
         table_name=TABLE_NAME,
-        model=assistant.model,
+        model=_get_assistant().model,
         welcome_message=WELCOME_MESSAGE,
     )
 
@@ -144,21 +311,23 @@ def index():
 @app.route("/health")
 def health():
     try:
-        db.ping()
-        records_db.ping()
-        cols = db.get_columns()
+        _get_db().ping()
+        _get_records_db().ping()
+        _get_session_store().ping()
+        columns_count = _columns_count()
         return jsonify(
             {
                 "ok": True,
                 "db": str(DB_PATH),
                 "table": TABLE_NAME,
-                "columns": len(cols),
+                "columns": columns_count,
                 "records_db": str(USER_DB_PATH),
+                "session_db": str(SESSION_DB_PATH),
                 "external_user_id_header": EXTERNAL_USER_ID_HEADER,
                 "perf_log_enabled": is_perf_log_enabled(),
                 "perf_log_path": str(get_perf_log_path()),
                 "app_debug": APP_DEBUG,
-                "web_tool_enabled": bool(getattr(assistant, "web_tool_enabled", False)),
+                "web_tool_enabled": bool(getattr(_get_assistant(), "web_tool_enabled", False)),
             }
         )
     except Exception as exc:
@@ -168,81 +337,140 @@ def health():
 @app.route("/capabilities", methods=["GET"])
 def capabilities():
     try:
-        text = CAPABILITIES_FILE.read_text(encoding="utf-8").strip()
+        text = _capabilities_text()
     except Exception as exc:
         return jsonify({"ok": False, "error": f"Не удалось прочитать capabilities: {exc}"}), 500
     return jsonify({"ok": True, "capabilities": text})
 
 
+def _chat_message(payload: dict) -> tuple[str, tuple | None]:
+    raw_message = payload.get("message", "")
+    if not isinstance(raw_message, str):
+        raw_message = str(raw_message)
+    # Заведомо длинный текст отклоняем до strip(), чтобы не копировать его целиком.
+    if len(raw_message) > MAX_MESSAGE_CHARS * 2:
+        return "", (jsonify({"response": "Слишком длинный запрос.", "meta": {"sql": None, "rows": 0}}), 400)
+    message = raw_message.strip()
+    if not message:
+        return "", (jsonify({"response": "Пустой запрос.", "meta": {"sql": None, "rows": 0}}), 400)
+    if len(message) > MAX_MESSAGE_CHARS:
+        return "", (jsonify({"response": "Слишком длинный запрос.", "meta": {"sql": None, "rows": 0}}), 400)
+    return message, None
+
+
+def _chat_error(exc: Exception) -> tuple[str, dict]:
+    answer = f"Ошибка обработки запроса: {exc}"
+    return answer, {"sql": None, "rows": 0, "model": _assistant.model if _assistant is not None else None}
+
+
+def _apply_chat_meta(sid: str, meta: dict, public_user: str | None, user_source: str) -> None:
+    if isinstance(meta, dict):
+        meta.setdefault("public_user", public_user)
+        meta.setdefault("public_user_source", user_source)
+        state_meta = _update_context_state_from_meta(sid, meta)
+        meta.setdefault("context", state_meta)
+
+
+def _finish_chat(
+    sid: str,
+    message: str,
+    answer: str,
+    meta: dict,
+    public_user: str | None,
+    user_source: str,
+    request_t0: int,
+) -> None:
+    request_ms = elapsed_ms(request_t0)
+    meta_dict = meta if isinstance(meta, dict) else {}
+    perf_meta = meta_dict.get("perf") or {}
+    append_perf_log(
+        "chat_request",
+        sid=sid[:10],
+        method=request.method,
+        path=request.path,
+        status="ok" if not str(answer).startswith("Ошибка обработки запроса:") else "error",
+        user_source=user_source,
+        public_user=public_user,
+        message_len=len(message),
+        response_len=len(str(answer or "")),
+        request_ms=request_ms,
+        **{key: perf_meta.get(key) for key in PERF_LOG_FIELDS},
+        rows=meta_dict.get("rows") if isinstance(meta, dict) else None,
+        sql_count=len(meta_dict.get("sql_queries") or ()),
+        web_count=len(meta_dict.get("web_queries") or ()),
+    )
+
+    # Реплики пользователя и ассистента записываются одной операцией после ответа.
+    _append_messages(sid, [("user", message), ("assistant", answer)])
+
+
 @app.route("/chat", methods=["POST"])
 def chat():
-    request_t0 = time.perf_counter()
-    payload = request.get_json(silent=True) or {}
-    message = str(payload.get("message", "")).strip()
-    if not message:
-        return jsonify({"response": "Пустой запрос.", "meta": {"sql": None, "rows": 0}}), 400
-    if len(message) > 4000:
-        return jsonify({"response": "Слишком длинный запрос.", "meta": {"sql": None, "rows": 0}}), 400
+    request_t0 = time.monotonic_ns()
+    payload = _json_payload()
+    message, error = _chat_message(payload)
+    if error is not None:
+        return error
 
     sid = _session_id()
-    history = list(_get_history(sid))
-    context_state = dict(_get_context_state(sid))
-    _append_history(sid, "user", message)
+    history = _history_snapshot(sid)
+    context_state = _get_context_state(sid)
 
     public_user, user_source = _resolve_effective_user(payload)
 
     try:
-        answer, meta = assistant.ask(
+        answer, meta = _get_assistant().ask(
             message,
             history=history,
             public_user=public_user,
             record_context=context_state,
         )
-        if isinstance(meta, dict):
-            meta.setdefault("public_user", public_user)
-            meta.setdefault("public_user_source", user_source)
-            state_meta = _update_context_state_from_meta(sid, meta)
-            meta.setdefault("context", state_meta)
+        _apply_chat_meta(sid, meta, public_user, user_source)
     except Exception as exc:
-        answer = f"Ошибка обработки запроса: {exc}"
-        meta = {"sql": None, "rows": 0, "model": assistant.model}
-
-    elapsed_ms = round((time.perf_counter() - request_t0) * 1000, 2)
-    perf_meta = meta.get("perf") if isinstance(meta, dict) else None
-    append_perf_log(
-        "chat_request",
-        sid=sid[:10],
-        method=request.method,
-        path=request.path,
-        status="ok" if not str(answer).startswith("Ошибка обработки запроса:") else "error",
-        user_source=user_source,
-        public_user=public_user,
-        message_len=len(message),
-        response_len=len(str(answer or "")),
-        request_ms=elapsed_ms,
-        llm_rounds=(perf_meta or {}).get("llm_rounds"),
-        selected_model=(perf_meta or {}).get("selected_model"),
-        llm_input_chars_total=(perf_meta or {}).get("llm_input_chars_total"),
-        llm_output_chars_total=(perf_meta or {}).get("llm_output_chars_total"),
-        llm_prompt_tokens_total=(perf_meta or {}).get("llm_prompt_tokens_total"),
-        llm_completion_tokens_total=(perf_meta or {}).get("llm_completion_tokens_total"),
-        llm_wait_ms_total=(perf_meta or {}).get("llm_wait_ms_total"),
-        db_tool_calls=(perf_meta or {}).get("db_tool_calls"),
-        db_query_ms_total=(perf_meta or {}).get("db_query_ms_total"),
-        web_tool_calls=(perf_meta or {}).get("web_tool_calls"),
-        web_query_ms_total=(perf_meta or {}).get("web_query_ms_total"),
-        fallback_web_calls=(perf_meta or {}).get("fallback_web_calls"),
-        fallback_web_ms_total=(perf_meta or {}).get("fallback_web_ms_total"),
-        total_ms=(perf_meta or {}).get("total_ms"),
-        rows=(meta or {}).get("rows") if isinstance(meta, dict) else None,
-        sql_count=len((meta or {}).get("sql_queries") or []) if isinstance(meta, dict) else 0,
-        web_count=len((meta or {}).get("web_queries") or []) if isinstance(meta, dict) else 0,
-    )
+        answer, meta = _chat_error(exc)
 
-    _append_history(sid, "assistant", answer)
+    _finish_chat(sid, message, answer, meta, public_user, user_source, request_t0)
     return jsonify({"response": answer, "meta": meta})
 
 
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    request_t0 = time.monotonic_ns()
+    payload = _json_payload()
+    message, error = _chat_message(payload)
+    if error is not None:
+        return error
+
+    sid = _session_id()
+    history = _history_snapshot(sid)
+    context_state = _get_context_state(sid)
+
+    public_user, user_source = _resolve_effective_user(payload)
+
+    def generate():
+        # NDJSON: {"type": "delta", "text": ...} по мере генерации, в конце {"type": "done", ...}.
+        try:
+            answer, meta = "", {}
+            for event in _get_assistant().ask_stream(
+                message,
+                history=history,
+                public_user=public_user,
+                record_context=context_state,
+            ):
+                if event[0] == "delta":
+                    yield fast_json.dumps_bytes({"type": "delta", "text": event[1]}) + b"\n"
+                elif event[0] == "done":
+                    _, answer, meta = event
+            _apply_chat_meta(sid, meta, public_user, user_source)
+        except Exception as exc:
+            answer, meta = _chat_error(exc)
+
+        _finish_chat(sid, message, answer, meta, public_user, user_source, request_t0)
+        yield fast_json.dumps_bytes({"type": "done", "response": answer, "meta": meta}, default=app.json.default) + b"\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 @app.route("/debug/perf/tail", methods=["GET"])
 def debug_perf_tail():
     lines_raw = str(request.args.get("lines", "100")).strip()
@@ -255,10 +483,13 @@ def debug_perf_tail():
     raw_lines = tail_perf_log(lines=lines)
     fmt = str(request.args.get("format", "text")).strip().lower()
     if fmt != "json":
-        payload = "\n".join(raw_lines) + ("\n" if raw_lines else "")
-        return Response(payload, content_type="text/plain; charset=utf-8")
+        # Отдаем строки потоком, без склейки всего tail в одну строку.
+        return Response(
+            (f"{line}\n" for line in raw_lines),
+            content_type="text/plain; charset=utf-8",
+        )
 
-    return jsonify(
+    body = fast_json.dumps_bytes(
         {
             "ok": True,
             "enabled": is_perf_log_enabled(),
@@ -267,11 +498,12 @@ def debug_perf_tail():
             "lines": raw_lines,
         }
     )
+    return Response(body, mimetype="application/json")
 
 
 @app.route("/api/records", methods=["POST"])
 def create_public_record():
-    payload = request.get_json(silent=True) or {}
+    payload = _json_payload()
 
     wine_id = str(payload.get("wine_id", "")).strip()
     record_type = str(payload.get("record_type", "")).strip()
@@ -279,7 +511,7 @@ def create_public_record():
     user, user_source = _resolve_effective_user(payload)
 
     try:
-        record = records_db.add_record(
+        record = _get_records_db().add_record(
             user=user,
             record_type=record_type,
             content=str(content) if content is not None else None,
@@ -307,7 +539,7 @@ def list_public_records():
     user = str(request.args.get("user", "")).strip() or None
 
     try:
-        records = records_db.list_records(wine_id=wine_id, record_type=record_type, user=user)
+        records = _get_records_db().list_records(wine_id=wine_id, record_type=record_type, user=user)
     except PublicRecordError as exc:
         return jsonify({"ok": False, "error": str(exc)}), 400
     except Exception as exc:
@@ -322,8 +554,8 @@ def list_public_records_by_wine(wine_id: str):
     user = str(request.args.get("user", "")).strip() or None
 
     try:
-        records = records_db.list_records(wine_id=wine_id, record_type=record_type, user=user)
-        summary = records_db.get_wine_summary(wine_id)
+        records = _get_records_db().list_records(wine_id=wine_id, record_type=record_type, user=user)
+        summary = _get_records_db().get_wine_summary(wine_id)
     except PublicRecordError as exc:
         return jsonify({"ok": False, "error": str(exc)}), 400
     except Exception as exc:
@@ -1,10 +1,15 @@
+import functools
 import json
 import os
 import re
 import time
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from itertools import islice
 from pathlib import Path
-from typing import Any
+from types import MappingProxyType, SimpleNamespace
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Sequence
 
 from dotenv import find_dotenv, load_dotenv
 try:
@@ -12,13 +17,638 @@ try:
 except Exception:
     OpenAI = None
 
+import fast_json
 from db import WineDB
+from perf_log import elapsed_ms
 from public_records_db import PublicRecordError, PublicRecordsDB
+from response_cache import ResponseCache, make_cache_key
 from sql_guard import SQLValidationError
 from web_search import search_wine_web
 
 load_dotenv(find_dotenv())
 
+_WORD_TOKEN_RE = re.compile(r"[0-9a-zа-яё]+", re.IGNORECASE)
+# Ссылки, www-адреса и домены вырезаются по очереди, как в исходной очистке всего текста:
+# порядок важен ("www.https://..." оставляет "www."), поэтому это не одна альтернация.
+# Ни один шаблон не пересекает перевод строки, так что их можно применять построчно.
+_LINK_RES = (
+    re.compile(r"https?://\S+", re.IGNORECASE),
+    re.compile(r"\bwww\.[^\s]+", re.IGNORECASE),
+    re.compile(r"\b(?:[a-z0-9-]+\.)+(?:ru|com|net|org|info|io|рф)\b(?:/[^\s]*)?", re.IGNORECASE),
+)
+_LINK_WORD_RE = re.compile(r"\bссылк[а-я]*\b", re.IGNORECASE)
+_MULTI_SPACE_RE = re.compile(r"\s{2,}")
+_NON_CYRILLIC_RE = re.compile(r"[^а-яё]")
+_LEADING_INT_RE = re.compile(r"(\d+)")
+_ALL_WORD_RE = re.compile(r"\bвсе\b")
+_FIRST_N_RE = re.compile(r"\bперв(?:ые|ых|ую|ой)?\s+([0-9а-яё-]+)\b")
+_LAST_N_RE = re.compile(r"\bпоследн(?:ие|их|юю|ей)?\s+([0-9а-яё-]+)\b")
+_COMPACT_RANGE_RE = re.compile(r"\s*(?:с|от)?\s*[0-9а-яё-]+\s*(?:по|до|-|–|—|\.\.)\s*[0-9а-яё-]+\s*")
+_NUM_RANGE_WORDS_RE = re.compile(r"(?:^|[\s,;])(?:с|от)?\s*(\d+)\s*(?:по|до)\s*(\d+)")
+_NUM_RANGE_DASH_RE = re.compile(r"\b(\d+)\s*(?:-|–|—|\.\.)\s*(\d+)\b")
+_WORD_RANGE_RE = re.compile(r"(?:с|от)\s+([0-9а-яё-]+)\s+(?:по|до)\s+([0-9а-яё-]+)")
+_NUMBERS_ONLY_RE = re.compile(r"[\d,\s;#№и\-]+")
+_POSITION_TOKEN_RE = re.compile(r"(\d+)|([а-яё-]+)")
+_CYRILLIC_ONLY_RE = re.compile(r"[а-яё,\s\-]+")
+_CHOSEN_NUMBER_RE = re.compile(r"\b(\d+)\s*(?:я|й)?\b")
+_NOTE_CONTENT_RE = re.compile(r"(?:текст заметки|заметка)\s+(.+)$", re.IGNORECASE)
+_WINE_REFERENCE_RES = tuple(
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        r"(?:для|к)\s*вину?\s+(.+)$",
+        r"вину?\s+(.+)$",
+        r"вина\s+(.+)$",
+    )
+)
+_MY_WORD_RE = re.compile(r"\bмои\b")
+
+_BLOCKED_LINE_MARKERS = (
+    "источники web-поиска",
+    "web-поиск",
+    "web search",
+    "источники поиска",
+    "источники:",
+)
+
+
+def _marker_re(markers: tuple[str, ...]) -> re.Pattern[str]:
+    # Одна альтернация вместо N проверок `m in q`: текст сканируется один раз.
+    return re.compile("|".join(re.escape(m) for m in markers))
+
+
+_FULL_LIST_MARKERS = tuple(
+    unicodedata.normalize("NFKC", m).replace("ё", "е")
+    for m in (
+        "полностью",
+        "полный список",
+        "весь список",
+        "этот список",
+        "все строки",
+        "все записи",
+        "без сокращ",
+        "покажи всё",
+        "покажи все",
+        "представь этот список полностью",
+    )
+)
+_CAPABILITIES_MARKERS = tuple(
+    unicodedata.normalize("NFKC", m).replace("ё", "е")
+    for m in (
+        "что ты умеешь",
+        "что умеет система",
+        "возможности",
+        "справка",
+        "help",
+        "шаблон",
+        "пример команд",
+        "покажи возможности",
+    )
+)
+_COMPLEX_MARKERS = (
+    "сравни",
+    "сравнение",
+    "проанализ",
+    "обоснуй",
+    "почему",
+    "подробно",
+    "сценар",
+    "стратег",
+    "подбери",
+    "рекоменд",
+    "пошагов",
+    "разлож",
+    "критер",
+    "несколько вариантов",
+)
+_PRICE_MARKERS = (
+    "цена",
+    "сколько стоит",
+    "стоит",
+    "налич",
+    "продается",
+    "продаётся",
+    "где купить",
+    "купить",
+    "на полке",
+    "в магазине",
+)
+_ALL_POSITIONS_MARKERS = (
+    "все позиции",
+    "всех позиций",
+    "все из списка",
+    "всех из списка",
+    "все позиции из списка",
+    "всех позиций из списка",
+    "все из результатов",
+    "все строки",
+    "всех строк",
+    "все пункты",
+    "всех пунктов",
+    "все варианты",
+    "всех вариантов",
+    "все вина из списка",
+    "все найденные",
+    "все найденные вина",
+    "все из них",
+    "все они",
+    "всем из списка",
+    "для всех позиций",
+    "для всех пунктов",
+    "по всем позициям",
+)
+_LIST_REFERENCE_MARKERS = (
+    "позици",
+    "номер",
+    "из списка",
+    "из результатов",
+    "вариант",
+    "пункт",
+    "строк",
+    "вино 1",
+    "вина 1",
+)
+_LIKE_INTENT_MARKERS = ("лайк", "нравится", "понравил", "отметь", "отметк", "отметка")
+_RECORD_ACTION_VERBS = (
+    "постав",
+    "добав",
+    "сдела",
+    "созда",
+    "сохрани",
+    "запиши",
+    "отметь",
+    "лайкни",
+)
+_RECORD_WORDS = ("лайк", "заметк", "отметк")
+# Фразы "покажи мои лайки" и т.п. покрываются маркерами "мои <основа>".
+_MY_RECORD_STEMS = ("отмет", "лайк", "замет", "запис")
+
+_BLOCKED_LINE_RE = _marker_re(_BLOCKED_LINE_MARKERS)
+_FULL_LIST_RE = _marker_re(_FULL_LIST_MARKERS)
+_CAPABILITIES_RE = _marker_re(_CAPABILITIES_MARKERS)
+_COMPLEX_RE = _marker_re(_COMPLEX_MARKERS)
+_COMPLEX_MIN_CHARS = 40
+_PRICE_RE = _marker_re(_PRICE_MARKERS)
+_ALL_POSITIONS_RE = _marker_re(_ALL_POSITIONS_MARKERS)
+_LIST_REFERENCE_RE = _marker_re(_LIST_REFERENCE_MARKERS)
+_LIKE_INTENT_RE = _marker_re(_LIKE_INTENT_MARKERS)
+_RECORD_ACTION_VERB_RE = _marker_re(_RECORD_ACTION_VERBS)
+_RECORD_WORD_RE = _marker_re(_RECORD_WORDS)
+_MY_RECORDS_RE = _marker_re(tuple(f"мои {stem}" for stem in _MY_RECORD_STEMS))
+_MY_RECORD_STEMS_RE = _marker_re(_MY_RECORD_STEMS)
+_WINE_TOPIC_RE = _marker_re(("вино", "вин", "сорт", "винтаж", "магнум", "игрист"))
+_LIST_WORDS_RE = _marker_re(("спис", "результат", "позиц", "пункт", "строк", "вариант"))
+_CHOOSE_VERB_RE = _marker_re(("выбираю", "беру", "выбери", "выберу"))
+_CHOSEN_VERB_RE = _marker_re(("выбираю", "беру"))
+
+_WEB_PRICE_CACHE_TTL_SEC = 600.0
+
+# Инструменты с побочными эффектами: внутри одного шага LLM выполняются строго по порядку.
+_SEQUENTIAL_TOOLS = frozenset({"add_public_record"})
+# Инструменты, не читающие и не меняющие публичные записи.
+_CATALOG_TOOLS = frozenset({"execute_sql", "search_web"})
+# Поля результата инструментов публичных записей, попадающие в meta["public_record_ops"].
+_PUBLIC_RECORD_OP_FIELDS: dict[str, Callable[[dict[str, Any]], dict[str, Any]]] = {
+    "add_public_record": lambda result: {"record": result.get("record")},
+    "list_public_records": lambda result: {"count": int(result.get("count") or 0)},
+    "get_wine_public_summary": lambda result: {"summary": result.get("summary")},
+}
+
+_SQL_TOOLS = (
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_sql",
+            "description": "Выполняет безопасный SELECT-запрос в SQLite и возвращает строки.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "SQL SELECT/CTE запрос к таблице wine_cards_wide",
+                    }
+                },
+                "required": ["query"],
+            },
+        },
+    },
+)
+_WEB_TOOLS = (
+    {
+        "type": "function",
+        "function": {
+            "name": "search_web",
+            "description": (
+                "Ищет информацию в интернете по винной теме: наличие в продаже, цены, магазины,"
+                " обзоры, новости."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Поисковый запрос",
+                    },
+                    "max_results": {
+                        "type": "integer",
+                        "description": "Максимум результатов (1..10)",
+                    },
+                },
+                "required": ["query"],
+            },
+        },
+    },
+)
+_RECORDS_TOOLS = (
+    {
+        "type": "function",
+        "function": {
+            "name": "add_public_record",
+            "description": (
+                "Добавляет публичную пользовательскую запись по вину: лайк или заметку."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "wine_id": {
+                        "type": "string",
+                        "description": "Идентификатор вина: card_key или url из wine_cards_wide",
+                    },
+                    "record_type": {
+                        "type": "string",
+                        "description": "Тип записи: like или note",
+                    },
+                    "content": {
+                        "type": "string",
+                        "description": "Содержимое заметки (для like можно не передавать)",
+                    },
+                    "user": {
+                        "type": "string",
+                        "description": "Имя пользователя (опционально)",
+                    },
+                },
+                "required": ["wine_id", "record_type"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "list_public_records",
+            "description": "Читает публичные записи пользователей (лайки/заметки).",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "wine_id": {
+                        "type": "string",
+                        "description": "Фильтр по вину (card_key или url)",
+                    },
+                    "record_type": {
+                        "type": "string",
+                        "description": "Фильтр: like или note",
+                    },
+                    "user": {
+                        "type": "string",
+                        "description": "Фильтр по имени пользователя",
+                    },
+                },
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_wine_public_summary",
+            "description": "Возвращает агрегат по публичным записям вина: число лайков и заметок.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "wine_id": {
+                        "type": "string",
+                        "description": "Идентификатор вина: card_key или url из wine_cards_wide",
+                    }
+                },
+                "required": ["wine_id"],
+            },
+        },
+    },
+)
+
+_ORDINAL_STEMS = {
+    "одиннадцат": 11,
+    "двенадцат": 12,
+    "тринадцат": 13,
+    "четырнадцат": 14,
+    "пятнадцат": 15,
+    "шестнадцат": 16,
+    "семнадцат": 17,
+    "восемнадцат": 18,
+    "девятнадцат": 19,
+    "двадцат": 20,
+    "десят": 10,
+    "девят": 9,
+    "восьм": 8,
+    "седьм": 7,
+    "шест": 6,
+    "пят": 5,
+    "четверт": 4,
+    "трет": 3,
+    "втор": 2,
+    "перв": 1,
+}
+_ORDINAL_STEMS_LENGTHS = tuple(sorted({len(stem) for stem in _ORDINAL_STEMS}, reverse=True))
+_COUNT_STEMS = {
+    "одиннадцат": 11,
+    "одиннадц": 11,
+    "двенадцат": 12,
+    "двенадц": 12,
+    "тринадцат": 13,
+    "тринадц": 13,
+    "четырнадцат": 14,
+    "четырнадц": 14,
+    "пятнадцат": 15,
+    "пятнадц": 15,
+    "шестнадцат": 16,
+    "шестнадц": 16,
+    "семнадцат": 17,
+    "семнадц": 17,
+    "восемнадцат": 18,
+    "восемнадц": 18,
+    "девятнадцат": 19,
+    "девятнадц": 19,
+    "двадцат": 20,
+    "десят": 10,
+    "девят": 9,
+    "восем": 8,
+    "сем": 7,
+    "шест": 6,
+    "пят": 5,
+    "четыр": 4,
+    "три": 3,
+    "два": 2,
+    "один": 1,
+}
+_COUNT_STEMS_LENGTHS = tuple(sorted({len(stem) for stem in _COUNT_STEMS}, reverse=True))
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_text(text: str) -> str:
+    q = (text or "").strip().lower()
+    # Одиночная замена ё через str.replace: translate с таблицей для не-ASCII текста в десятки раз медленнее.
+    return unicodedata.normalize("NFKC", q).replace("ё", "е")
+
+
+# Реплики в чате часто повторяются ("да", "еще", "покажи все"), поэтому решение о модели кэшируется.
+@functools.lru_cache(maxsize=4096)
+def _is_complex_query(text: str) -> bool:
+    q = _normalize_text(text)
+    if not q:
+        return False
+    if len(q) >= 180:
+        return True
+
+    if _COMPLEX_RE.search(q):
+        return True
+    # Короткие реплики без маркеров ("да", "3", "покажи все") сразу уходят в быструю модель.
+    if len(q) < _COMPLEX_MIN_CHARS:
+        return False
+
+    separators = q.count(" и ") + q.count(" или ") + q.count(",")
+    if separators >= 4:
+        return True
+
+    if q.count("?") >= 2:
+        return True
+    return False
+
+
+def _wine_id_of(item: Any) -> str:
+    value = item.get("wine_id") if isinstance(item, dict) else None
+    return str(value or "").strip()
+
+
+class _TextClassification(NamedTuple):
+    norm_text: str
+    is_capabilities: bool
+    is_full_list: bool
+    is_complex: bool
+
+
+class _PendingRecordAction(NamedTuple):
+    # Незавершенное действие с лайком/заметкой из контекста сессии, разобранное один раз.
+    record_type: str
+    content: str | None
+    reference: str
+    candidates: list[Any] | None
+    selected: dict[str, Any] | None
+    selected_list: list[dict[str, Any]]
+    candidates_prompt: str | None
+
+    @classmethod
+    def from_context(cls, value: Any) -> "_PendingRecordAction | None":
+        if not isinstance(value, dict) or not value:
+            return None
+        candidates = value.get("candidates")
+        selected = value.get("selected")
+        selected_list = value.get("selected_list")
+        prompt = value.get("candidates_prompt")
+        return cls(
+            record_type=str(value.get("record_type") or "").strip(),
+            content=str(value.get("content") or "").strip() or None,
+            reference=str(value.get("reference") or "").strip(),
+            candidates=candidates if isinstance(candidates, list) else None,
+            selected=selected if isinstance(selected, dict) else None,
+            selected_list=(
+                [c for c in selected_list if isinstance(c, dict)] if isinstance(selected_list, list) else []
+            ),
+            candidates_prompt=prompt if isinstance(prompt, str) else None,
+        )
+
+
+# Все признаки реплики, которые нужны ask(), считаются за один вызов и кэшируются по тексту.
+@functools.lru_cache(maxsize=4096)
+def _classify_text(text: str) -> _TextClassification:
+    q = _normalize_text(text)
+    return _TextClassification(
+        norm_text=q,
+        is_capabilities=_CAPABILITIES_RE.search(q) is not None,
+        is_full_list=_FULL_LIST_RE.search(q) is not None,
+        is_complex=_is_complex_query(text),
+    )
+
+
+# Повторные вызовы инструмента с теми же аргументами (ретраи, повтор SQL) не парсят JSON заново.
+# Результат общий для всех потоков, поэтому отдается только для чтения.
+@functools.lru_cache(maxsize=256)
+def _parse_tool_args(raw: str | None) -> MappingProxyType | None:
+    try:
+        args = fast_json.loads(raw or "{}")
+    except json.JSONDecodeError:
+        return None
+    return MappingProxyType(args) if isinstance(args, dict) else None
+
+
+class _AnswerSanitizer:
+    # Построчная очистка ответа от ссылок и упоминаний web-источников.
+    # Ссылки не пересекают границы строк, поэтому текст можно подавать кусками
+    # по мере стриминга LLM и отдавать клиенту только завершенные строки.
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._has_output = False
+        self._pending_blank = False
+        self._after_cr = False
+
+    def feed(self, text: str) -> str:
+        self._buffer += text
+        pieces = self._buffer.splitlines(keepends=True)
+        if not pieces:
+            return ""
+        last = pieces[-1]
+        # Незавершенная строка (или одиночный \r перед возможным \n) ждет следующего куска.
+        if last.endswith("\r") or last.splitlines() == [last]:
+            self._buffer = pieces.pop()
+        else:
+            self._buffer = ""
+        return "".join(self._emit_line(piece) for piece in pieces)
+
+    def finish(self) -> str:
+        tail, self._buffer = self._buffer, ""
+        return "".join(self._emit_line(piece) for piece in tail.splitlines(keepends=True))
+
+    def _emit_line(self, piece: str) -> str:
+        raw_line = piece.splitlines()[0]
+        line = raw_line
+        for link_re in _LINK_RES:
+            line = link_re.sub("", line)
+        # Исходная очистка вырезала ссылки из всего текста до разбиения на строки: строка из одной
+        # ссылки между "\r" и "\n" склеивалась в один перевод строки "\r\n" и пустой строкой не считалась.
+        ending = piece[len(raw_line):]
+        merged = self._after_cr and not line and ending == "\n"
+        self._after_cr = ending == "\r"
+        if merged:
+            return ""
+        line = line.strip()
+        low = line.lower()
+        if _BLOCKED_LINE_RE.search(low):
+            return ""
+        if "ссылк" in low:
+            line = _LINK_WORD_RE.sub("", line).strip()
+        line = _MULTI_SPACE_RE.sub(" ", line)
+        if not line:
+            self._pending_blank = self._has_output
+            return ""
+        prefix = ""
+        if self._has_output:
+            prefix = "\n\n" if self._pending_blank else "\n"
+        self._has_output = True
+        self._pending_blank = False
+        return prefix + line
+
+
+def _match_stem(word: str, stems: dict[str, int], lengths: tuple[int, ...]) -> int | None:
+    # Самая длинная основа проверяется первой: "одиннадцат" раньше "один".
+    for length in lengths:
+        value = stems.get(word[:length])
+        if value is not None:
+            return value
+    return None
+
+
+@functools.lru_cache(maxsize=2048)
+def _word_to_int(word: str, ordinal: bool) -> int | None:
+    # Словарь числительных мал и повторяется из запроса в запрос: результат по слову кэшируется.
+    w = word.lower().strip()
+    if not w:
+        return None
+    w = _NON_CYRILLIC_RE.sub("", w).replace("ё", "е")
+    if ordinal:
+        return _match_stem(w, _ORDINAL_STEMS, _ORDINAL_STEMS_LENGTHS)
+    return _match_stem(w, _COUNT_STEMS, _COUNT_STEMS_LENGTHS)
+
+
+@functools.lru_cache(maxsize=8)
+def _db_prompt_inputs(db: WineDB) -> tuple[str, tuple[tuple[str, tuple[str, ...]], ...]]:
+    # Схема и справочники каталога статичны: читаем их один раз на экземпляр БД.
+    refs = db.get_reference_values()
+    refs_key = tuple((name, tuple(values)) for name, values in sorted(refs.items()))
+    return db.get_schema_string(), refs_key
+
+
+@functools.lru_cache(maxsize=8)
+def _render_system_prompt(
+    schema: str,
+    refs_key: tuple[tuple[str, tuple[str, ...]], ...],
+    capabilities_text: str,
+    web_tool_enabled: bool,
+) -> str:
+    refs = dict(refs_key)
+
+    def fmt(name: str) -> str:
+        values = refs.get(name, ())
+        if not values:
+            return f"{name}: []"
+        return f"{name}: " + ", ".join(values)
+
+    web_rules = (
+        "8) Если пользователь спрашивает о наличии в продаже, цене на полке, магазинах или другой "
+        "внешней информации, используй search_web.\n"
+        "9) В ответе пользователю запрещено указывать URL, названия сайтов и любые веб-источники.\n"
+        "10) Для цены и наличия указывай, что это рыночные данные, "
+        "которые могут отличаться по регионам/магазинам.\n"
+        "11) Если в локальной базе данных не найдено совпадений по названию вина, "
+        "используй search_web, чтобы дать практичный ответ без ссылок.\n"
+        if web_tool_enabled
+        else "8) Web-поиск отключен. Отвечай только на данных локальной базы.\n"
+    )
+
+    return (
+        "Ты винный ассистент. Поддерживай разговор на темы вина.\n\n"
+        f"{schema}\n\n"
+        "Справочники (используй только эти значения в фильтрах):\n"
+        f"- {fmt('wine_color')}\n"
+        f"- {fmt('sugar_style')}\n"
+        f"- {fmt('rating_status')}\n"
+        f"- {fmt('region')}\n"
+        f"- {fmt('price_quality')}\n"
+        f"- recommendations: {', '.join(refs.get('recommendations', ()))}\n\n"
+        "Правила работы:\n"
+        "1) Только SELECT или WITH.\n"
+        "2) Для данных из локальной базы используй execute_sql и таблицу wine_cards_wide.\n"
+        "3) Для строк-списков (grapes, recommendations, available_vintages) используй LIKE.\n"
+        "4) Не используй DDL/DML.\n"
+        "5) alcohol_pct уже целое число процента.\n"
+        "6) Если пользователь просит топ/список, сортируй явно и ограничивай выдачу.\n"
+        "7) Если пользователь просит полный список (полностью/весь список/без сокращений), "
+        "нельзя сокращать ответ и писать '... и еще N'.\n"
+        f"{web_rules}"
+        "12) Если пользователь просит поставить лайк/добавить заметку/показать заметки и лайки, "
+        "используй инструменты публичных записей.\n"
+        "13) Если пользователь спрашивает о возможностях системы, выдай краткую сводку.\n"
+        "14) При поиске производителя учитывай возможные русские/латинские написания "
+        "и делай фильтр с OR по вариантам.\n"
+        "15) Если вопрос не о вине — вежливо откажись и предложи винную тему.\n\n"
+        "Соответствия написаний производителей:\n"
+        "- шато ле гранд восток <-> Chateau le Grand Vostock\n"
+        "- абрау-дюрсо <-> Abrau-Durso\n"
+        "- эссе <-> Esse\n\n"
+        "Сводка возможностей системы:\n"
+        f"{capabilities_text}"
+    )
+
+
+_PRETTY_LABELS = {
+    "wine_name": "Вино",
+    "producer": "Производитель",
+    "harvest_year": "Урожай",
+    "rating_points": "Рейтинг",
+    "rating_year": "Год оценки",
+    "region": "Регион",
+    "url": "Ссылка",
+    "wine_color": "Цвет",
+    "sugar_style": "Сахарность",
+    "alcohol_pct": "Алкоголь (%)",
+    "price_quality": "Цена/качество",
+}
+
 
 class WineAssistant:
     @staticmethod
@@ -59,136 +689,47 @@ class WineAssistant:
             os.getenv("OPENAI_MAX_COMPLETION_TOKENS", "1200")
         )
         self.web_tool_enabled = self._env_bool("WINE_WEB_TOOL_ENABLED", default=False)
-        self.capabilities_text = self._load_capabilities_text(capabilities_path)
+        self._tool_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="wine-tool")
+        self.tool_cache = ResponseCache(
+            max_size=512,
+            ttl_sec=float(os.getenv("WINE_TOOL_CACHE_TTL_SEC", "3600")),
+        )
+        self.response_cache = ResponseCache(
+            max_size=int(os.getenv("WINE_RESPONSE_CACHE_SIZE", "1024")),
+            ttl_sec=float(os.getenv("WINE_RESPONSE_CACHE_TTL_SEC", "3600")),
+        )
+        self._capabilities_path = capabilities_path
+
+        self.tools = (
+            _SQL_TOOLS
+            + (_WEB_TOOLS if self.web_tool_enabled else ())
+            + (_RECORDS_TOOLS if self.records_db is not None else ())
+        )
+        # Набор инструментов фиксирован на весь срок жизни ассистента: имена входят в ключ кэша ответов.
+        self._tool_names = tuple(tool["function"]["name"] for tool in self.tools)
+        # Обработчики вызовов инструментов: (arguments, force_full, public_user) -> результат.
+        self._tool_handlers: dict[str, Callable[[str, bool, str | None], dict[str, Any]]] = {
+            "execute_sql": lambda args, full, user: self._tool_response(args, include_full_rows=full),
+            "search_web": lambda args, full, user: self._tool_web_response(args),
+            "add_public_record": lambda args, full, user: self._tool_public_add_response(args, default_user=user),
+            "list_public_records": lambda args, full, user: self._tool_public_list_response(args),
+            "get_wine_public_summary": lambda args, full, user: self._tool_public_summary_response(args),
+        }
 
+    # Клиент OpenAI, сводка возможностей и system prompt создаются при первом обращении:
+    # короткие сценарии (справка, лайки по контексту) обходятся без них.
+    @cached_property
+    def client(self) -> Any:
         api_key = os.getenv("OPENAI_API_KEY")
-        self.client = OpenAI(api_key=api_key) if (OpenAI and api_key) else None
-        self.system_prompt = self._build_system_prompt()
+        return OpenAI(api_key=api_key) if (OpenAI and api_key) else None
 
-        self.tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "execute_sql",
-                    "description": "Выполняет безопасный SELECT-запрос в SQLite и возвращает строки.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "SQL SELECT/CTE запрос к таблице wine_cards_wide",
-                            }
-                        },
-                        "required": ["query"],
-                    },
-                },
-            },
-        ]
-        if self.web_tool_enabled:
-            self.tools.append(
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "search_web",
-                        "description": (
-                            "Ищет информацию в интернете по винной теме: наличие в продаже, цены, магазины,"
-                            " обзоры, новости."
-                        ),
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "query": {
-                                    "type": "string",
-                                    "description": "Поисковый запрос",
-                                },
-                                "max_results": {
-                                    "type": "integer",
-                                    "description": "Максимум результатов (1..10)",
-                                },
-                            },
-                            "required": ["query"],
-                        },
-                    },
-                }
-            )
+    @cached_property
+    def capabilities_text(self) -> str:
+        return self._load_capabilities_text(self._capabilities_path)
 
-        if self.records_db is not None:
-            self.tools.extend(
-                [
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "add_public_record",
-                            "description": (
-                                "Добавляет публичную пользовательскую запись по вину: лайк или заметку."
-                            ),
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "wine_id": {
-                                        "type": "string",
-                                        "description": "Идентификатор вина: card_key или url из wine_cards_wide",
-                                    },
-                                    "record_type": {
-                                        "type": "string",
-                                        "description": "Тип записи: like или note",
-                                    },
-                                    "content": {
-                                        "type": "string",
-                                        "description": "Содержимое заметки (для like можно не передавать)",
-                                    },
-                                    "user": {
-                                        "type": "string",
-                                        "description": "Имя пользователя (опционально)",
-                                    },
-                                },
-                                "required": ["wine_id", "record_type"],
-                            },
-                        },
-                    },
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "list_public_records",
-                            "description": "Читает публичные записи пользователей (лайки/заметки).",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "wine_id": {
-                                        "type": "string",
-                                        "description": "Фильтр по вину (card_key или url)",
-                                    },
-                                    "record_type": {
-                                        "type": "string",
-                                        "description": "Фильтр: like или note",
-                                    },
-                                    "user": {
-                                        "type": "string",
-                                        "description": "Фильтр по имени пользователя",
-                                    },
-                                },
-                            },
-                        },
-                    },
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "get_wine_public_summary",
-                            "description": "Возвращает агрегат по публичным записям вина: число лайков и заметок.",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "wine_id": {
-                                        "type": "string",
-                                        "description": "Идентификатор вина: card_key или url из wine_cards_wide",
-                                    }
-                                },
-                                "required": ["wine_id"],
-                            },
-                        },
-                    },
-                ]
-            )
+    @cached_property
+    def system_prompt(self) -> str:
+        return self._build_system_prompt()
 
     @staticmethod
     def _load_capabilities_text(capabilities_path: str | Path | None) -> str:
@@ -206,337 +747,105 @@ class WineAssistant:
         )
 
     def _build_system_prompt(self) -> str:
-        schema = self.db.get_schema_string()
-        refs = self.db.get_reference_values()
-
-        def fmt(name: str) -> str:
-            values = refs.get(name, [])
-            if not values:
-                return f"{name}: []"
-            return f"{name}: " + ", ".join(values)
-
-        web_rules = (
-            "8) Если пользователь спрашивает о наличии в продаже, цене на полке, магазинах или другой "
-            "внешней информации, используй search_web.\n"
-            "9) В ответе пользователю запрещено указывать URL, названия сайтов и любые веб-источники.\n"
-            "10) Для цены и наличия указывай, что это рыночные данные, "
-            "которые могут отличаться по регионам/магазинам.\n"
-            "11) Если в локальной базе данных не найдено совпадений по названию вина, "
-            "используй search_web, чтобы дать практичный ответ без ссылок.\n"
-            if self.web_tool_enabled
-            else "8) Web-поиск отключен. Отвечай только на данных локальной базы.\n"
-        )
-
-        return (
-            "Ты винный ассистент. Поддерживай разговор на темы вина.\n\n"
-            f"{schema}\n\n"
-            "Справочники (используй только эти значения в фильтрах):\n"
-            f"- {fmt('wine_color')}\n"
-            f"- {fmt('sugar_style')}\n"
-            f"- {fmt('rating_status')}\n"
-            f"- {fmt('region')}\n"
-            f"- {fmt('price_quality')}\n"
-            f"- recommendations: {', '.join(refs.get('recommendations', []))}\n\n"
-            "Правила работы:\n"
-            "1) Только SELECT или WITH.\n"
-            "2) Для данных из локальной базы используй execute_sql и таблицу wine_cards_wide.\n"
-            "3) Для строк-списков (grapes, recommendations, available_vintages) используй LIKE.\n"
-            "4) Не используй DDL/DML.\n"
-            "5) alcohol_pct уже целое число процента.\n"
-            "6) Если пользователь просит топ/список, сортируй явно и ограничивай выдачу.\n"
-            "7) Если пользователь просит полный список (полностью/весь список/без сокращений), "
-            "нельзя сокращать ответ и писать '... и еще N'.\n"
-            f"{web_rules}"
-            "12) Если пользователь просит поставить лайк/добавить заметку/показать заметки и лайки, "
-            "используй инструменты публичных записей.\n"
-            "13) Если пользователь спрашивает о возможностях системы, выдай краткую сводку.\n"
-            "14) При поиске производителя учитывай возможные русские/латинские написания "
-            "и делай фильтр с OR по вариантам.\n"
-            "15) Если вопрос не о вине — вежливо откажись и предложи винную тему.\n\n"
-            "Соответствия написаний производителей:\n"
-            "- шато ле гранд восток <-> Chateau le Grand Vostock\n"
-            "- абрау-дюрсо <-> Abrau-Durso\n"
-            "- эссе <-> Esse\n\n"
-            "Сводка возможностей системы:\n"
-            f"{self.capabilities_text}"
-        )
+        schema, refs_key = _db_prompt_inputs(self.db)
+        return _render_system_prompt(schema, refs_key, self.capabilities_text, self.web_tool_enabled)
 
     @staticmethod
-    def _is_full_list_request(text: str) -> bool:
-        q = (text or "").strip().lower()
-        q = unicodedata.normalize("NFKC", q).replace("ё", "е")
-        markers = (
-            "полностью",
-            "полный список",
-            "весь список",
-            "этот список",
-            "все строки",
-            "все записи",
-            "без сокращ",
-            "покажи всё",
-            "покажи все",
-            "представь этот список полностью",
-        )
-        normalized_markers = [unicodedata.normalize("NFKC", m).replace("ё", "е") for m in markers]
-        return any(m in q for m in normalized_markers)
+    def _is_full_list_request(text: str, norm_text: str | None = None) -> bool:
+        q = norm_text if norm_text is not None else _normalize_text(text)
+        return _FULL_LIST_RE.search(q) is not None
 
     @staticmethod
-    def _is_capabilities_request(text: str) -> bool:
-        q = (text or "").strip().lower()
-        q = unicodedata.normalize("NFKC", q).replace("ё", "е")
-        markers = (
-            "что ты умеешь",
-            "что умеет система",
-            "возможности",
-            "справка",
-            "help",
-            "шаблон",
-            "пример команд",
-            "покажи возможности",
-        )
-        normalized = [unicodedata.normalize("NFKC", m).replace("ё", "е") for m in markers]
-        return any(m in q for m in normalized)
+    def _is_capabilities_request(text: str, norm_text: str | None = None) -> bool:
+        q = norm_text if norm_text is not None else _normalize_text(text)
+        return _CAPABILITIES_RE.search(q) is not None
 
     @staticmethod
     def _is_complex_query(text: str) -> bool:
-        q = WineAssistant._normalize_text(text)
-        if not q:
-            return False
-        if len(q) >= 180:
-            return True
-
-        complex_markers = (
-            "сравни",
-            "сравнение",
-            "проанализ",
-            "обоснуй",
-            "почему",
-            "подробно",
-            "сценар",
-            "стратег",
-            "подбери",
-            "рекоменд",
-            "пошагов",
-            "разлож",
-            "критер",
-            "несколько вариантов",
-        )
-        if any(m in q for m in complex_markers):
-            return True
-
-        separators = q.count(" и ") + q.count(" или ") + q.count(",")
-        if separators >= 4:
-            return True
-
-        if q.count("?") >= 2:
-            return True
-        return False
+        return _is_complex_query(text)
 
-    def _select_model_for_query(self, user_text: str) -> str:
+    def _select_model_for_query(self, user_text: str, is_complex: bool | None = None) -> str:
         if self.model_complex == self.model_fast:
             return self.model_fast
-        if self._is_complex_query(user_text):
-            return self.model_complex
-        return self.model_fast
+        if is_complex is None:
+            is_complex = self._is_complex_query(user_text)
+        return self.model_complex if is_complex else self.model_fast
 
     @staticmethod
     def _pretty_key(name: str) -> str:
-        labels = {
-            "wine_name": "Вино",
-            "producer": "Производитель",
-            "harvest_year": "Урожай",
-            "rating_points": "Рейтинг",
-            "rating_year": "Год оценки",
-            "region": "Регион",
-            "url": "Ссылка",
-            "wine_color": "Цвет",
-            "sugar_style": "Сахарность",
-            "alcohol_pct": "Алкоголь (%)",
-            "price_quality": "Цена/качество",
-        }
-        return labels.get(name, name)
+        return _PRETTY_LABELS.get(name, name)
 
     def _format_full_list_answer(self, rows: list[dict[str, Any]]) -> str:
         if not rows:
             return "Ничего не найдено."
-
-        lines = [f"Найдено записей: {len(rows)}. Полный список:"]
+        return "\n".join(self._iter_full_list_lines(rows))
+
+    def _iter_full_list_lines(self, rows: list[dict[str, Any]]) -> Iterator[str]:
+        yield f"Найдено записей: {len(rows)}. Полный список:"
+        # Подписи колонок одинаковы для всех строк: считаем их один раз на набор ключей.
+        labels: dict[Any, str | None] = {}
+        label_get = _PRETTY_LABELS.get
+        join = " | ".join
         for idx, row in enumerate(rows, 1):
             parts: list[str] = []
             for key, value in row.items():
-                if str(key).lower() == "url":
-                    continue
                 if value is None:
                     continue
-                text = str(value).strip()
-                if not text:
+                if key not in labels:
+                    labels[key] = None if str(key).lower() == "url" else label_get(key, key)
+                label = labels[key]
+                if label is None:
                     continue
-                parts.append(f"{self._pretty_key(key)}: {text}")
-            if not parts:
-                parts = ["(пустая строка)"]
-            lines.append(f"{idx}. " + " | ".join(parts))
-        return "\n".join(lines)
+                text = str(value).strip()
+                if text:
+                    parts.append(f"{label}: {text}")
+            yield f"{idx}. " + (join(parts) if parts else "(пустая строка)")
 
     @staticmethod
     def _is_price_or_availability_request(text: str) -> bool:
         q = (text or "").lower()
-        markers = (
-            "цена",
-            "сколько стоит",
-            "стоит",
-            "налич",
-            "продается",
-            "продаётся",
-            "где купить",
-            "купить",
-            "на полке",
-            "в магазине",
-        )
-        return any(m in q for m in markers)
+        return _PRICE_RE.search(q) is not None
 
     @staticmethod
     def _looks_like_wine_name_or_topic(text: str) -> bool:
         q = (text or "").strip().lower()
         if not q:
             return False
-        if any(m in q for m in ("вино", "вин", "сорт", "винтаж", "магнум", "игрист")):
+        if _WINE_TOPIC_RE.search(q):
             return True
-        tokens = re.findall(r"[0-9a-zа-яё]+", q, flags=re.IGNORECASE)
+        tokens = _WORD_TOKEN_RE.findall(q)
         return 1 <= len(tokens) <= 8 and len(q) <= 90
 
     @staticmethod
-    def _dedupe_web_results(results: list[dict[str, Any]]) -> list[dict[str, Any]]:
-        seen: set[str] = set()
-        out: list[dict[str, Any]] = []
+    def _merge_web_results(hits: dict[str, dict[str, Any]], results: Any) -> None:
+        # Результаты web-поиска копятся сразу без дублей по url, в порядке появления.
+        if not isinstance(results, list):
+            return
         for item in results:
-            url = str(item.get("url", "")).strip()
-            if not url or url in seen:
-                continue
-            seen.add(url)
-            out.append(item)
-        return out
+            if isinstance(item, dict):
+                url = str(item.get("url", "")).strip()
+                if url and url not in hits:
+                    hits[url] = item
 
     @staticmethod
     def _sanitize_public_answer(text: str) -> str:
-        cleaned = str(text or "")
-
-        # Remove direct links and domain-like mentions.
-        cleaned = re.sub(r"https?://\S+", "", cleaned, flags=re.IGNORECASE)
-        cleaned = re.sub(r"\bwww\.[^\s]+", "", cleaned, flags=re.IGNORECASE)
-        cleaned = re.sub(
-            r"\b(?:[a-z0-9-]+\.)+(?:ru|com|net|org|info|io|рф)\b(?:/[^\s]*)?",
-            "",
-            cleaned,
-            flags=re.IGNORECASE,
-        )
-
-        blocked_line_markers = (
-            "источники web-поиска",
-            "web-поиск",
-            "web search",
-            "источники поиска",
-            "источники:",
-        )
-
-        lines: list[str] = []
-        for raw_line in cleaned.splitlines():
-            line = raw_line.strip()
-            low = line.lower()
-            if any(marker in low for marker in blocked_line_markers):
-                continue
-            line = re.sub(r"\bссылк[а-я]*\b", "", line, flags=re.IGNORECASE).strip()
-            line = re.sub(r"\s{2,}", " ", line)
-            if line:
-                lines.append(line)
-            elif lines and lines[-1] != "":
-                lines.append("")
-
-        cleaned = "\n".join(lines).strip()
-        cleaned = re.sub(r"\n{3,}", "\n\n", cleaned)
-
+        sanitizer = _AnswerSanitizer()
+        cleaned = sanitizer.feed(str(text or "")) + sanitizer.finish()
         if not cleaned:
             return "Готов ответить по данным базы российских вин. Сформулируйте запрос."
         return cleaned
 
     @staticmethod
     def _normalize_text(text: str) -> str:
-        q = (text or "").strip().lower()
-        return unicodedata.normalize("NFKC", q).replace("ё", "е")
+        return _normalize_text(text)
 
     @staticmethod
     def _ordinal_word_to_int(word: str) -> int | None:
-        w = str(word or "").lower().strip()
-        if not w:
-            return None
-        w = re.sub(r"[^а-яё]", "", w).replace("ё", "е")
-        stems = [
-            ("одиннадцат", 11),
-            ("двенадцат", 12),
-            ("тринадцат", 13),
-            ("четырнадцат", 14),
-            ("пятнадцат", 15),
-            ("шестнадцат", 16),
-            ("семнадцат", 17),
-            ("восемнадцат", 18),
-            ("девятнадцат", 19),
-            ("двадцат", 20),
-            ("десят", 10),
-            ("девят", 9),
-            ("восьм", 8),
-            ("седьм", 7),
-            ("шест", 6),
-            ("пят", 5),
-            ("четверт", 4),
-            ("трет", 3),
-            ("втор", 2),
-            ("перв", 1),
-        ]
-        for stem, value in stems:
-            if w.startswith(stem):
-                return value
-        return None
+        return _word_to_int(str(word or ""), ordinal=True)
 
     @staticmethod
     def _count_word_to_int(word: str) -> int | None:
-        w = str(word or "").lower().strip()
-        if not w:
-            return None
-        w = re.sub(r"[^а-яё]", "", w).replace("ё", "е")
-        stems = [
-            ("одиннадцат", 11),
-            ("одиннадц", 11),
-            ("двенадцат", 12),
-            ("двенадц", 12),
-            ("тринадцат", 13),
-            ("тринадц", 13),
-            ("четырнадцат", 14),
-            ("четырнадц", 14),
-            ("пятнадцат", 15),
-            ("пятнадц", 15),
-            ("шестнадцат", 16),
-            ("шестнадц", 16),
-            ("семнадцат", 17),
-            ("семнадц", 17),
-            ("восемнадцат", 18),
-            ("восемнадц", 18),
-            ("девятнадцат", 19),
-            ("девятнадц", 19),
-            ("двадцат", 20),
-            ("десят", 10),
-            ("девят", 9),
-            ("восем", 8),
-            ("сем", 7),
-            ("шест", 6),
-            ("пят", 5),
-            ("четыр", 4),
-            ("три", 3),
-            ("два", 2),
-            ("один", 1),
-        ]
-        for stem, value in stems:
-            if w.startswith(stem):
-                return value
-        return None
+        return _word_to_int(str(word or ""), ordinal=False)
 
     def _position_token_to_int(self, token: str) -> int | None:
         t = self._normalize_text(token)
@@ -545,7 +854,7 @@ class WineAssistant:
         t = t.strip().strip(".,;:()[]{}")
         if not t:
             return None
-        m = re.match(r"^(\d+)", t)
+        m = _LEADING_INT_RE.match(t)
         if m:
             return int(m.group(1))
         return self._ordinal_word_to_int(t)
@@ -554,7 +863,7 @@ class WineAssistant:
         t = self._normalize_text(token)
         if not t:
             return None
-        m = re.match(r"^(\d+)", t)
+        m = _LEADING_INT_RE.match(t)
         if m:
             return int(m.group(1))
         return self._count_word_to_int(t)
@@ -562,55 +871,18 @@ class WineAssistant:
     @staticmethod
     def _is_all_positions_phrase(text: str) -> bool:
         q = str(text or "")
-        markers = (
-            "все позиции",
-            "всех позиций",
-            "все из списка",
-            "всех из списка",
-            "все позиции из списка",
-            "всех позиций из списка",
-            "все из результатов",
-            "все строки",
-            "всех строк",
-            "все пункты",
-            "всех пунктов",
-            "все варианты",
-            "всех вариантов",
-            "все вина из списка",
-            "все найденные",
-            "все найденные вина",
-            "все из них",
-            "все они",
-            "всем из списка",
-            "для всех позиций",
-            "для всех пунктов",
-            "по всем позициям",
-        )
-        if any(m in q for m in markers):
+        if _ALL_POSITIONS_RE.search(q):
             return True
         if q.strip() in {"все", "все их", "все они", "всем", "всех"}:
             return True
-        if re.search(r"\bвсе\b", q) and any(
-            x in q for x in ("спис", "результат", "позиц", "пункт", "строк", "вариант")
-        ):
+        if _ALL_WORD_RE.search(q) and _LIST_WORDS_RE.search(q):
             return True
         return False
 
     @staticmethod
     def _has_list_reference_phrase(text: str) -> bool:
         q = str(text or "")
-        markers = (
-            "позици",
-            "номер",
-            "из списка",
-            "из результатов",
-            "вариант",
-            "пункт",
-            "строк",
-            "вино 1",
-            "вина 1",
-        )
-        return any(m in q for m in markers)
+        return _LIST_REFERENCE_RE.search(q) is not None
 
     @staticmethod
     def _expand_range(start: int, end: int) -> list[int]:
@@ -633,13 +905,13 @@ class WineAssistant:
 
         # "первые 3", "первые три", "последние 2"
         if max_n:
-            m_first = re.search(r"\bперв(?:ые|ых|ую|ой)?\s+([0-9а-яё-]+)\b", q)
+            m_first = _FIRST_N_RE.search(q)
             if m_first:
                 n = self._count_token_to_int(m_first.group(1))
                 if n and n > 0:
                     n = min(n, max_n)
                     return list(range(1, n + 1))
-            m_last = re.search(r"\bпоследн(?:ие|их|юю|ей)?\s+([0-9а-яё-]+)\b", q)
+            m_last = _LAST_N_RE.search(q)
             if m_last:
                 n = self._count_token_to_int(m_last.group(1))
                 if n and n > 0:
@@ -647,17 +919,24 @@ class WineAssistant:
                     return list(range(max_n - n + 1, max_n + 1))
 
         list_ref = self._has_list_reference_phrase(q)
-        compact_range = bool(
-            re.fullmatch(r"\s*(?:с|от)?\s*[0-9а-яё-]+\s*(?:по|до|-|–|—|\.\.)\s*[0-9а-яё-]+\s*", q)
-        )
+        compact_range = bool(_COMPACT_RANGE_RE.fullmatch(q))
         allow_list_parsing = bool(max_n) or list_ref or compact_range
 
+        # Один проход по тексту: числа и кириллические слова нужны почти всем веткам ниже.
+        digits: list[int] = []
+        words: list[str] = []
+        for num, word in _POSITION_TOKEN_RE.findall(q):
+            if num:
+                digits.append(int(num))
+            else:
+                words.append(word)
+
         # Numeric ranges: "3-5", "3..5", "с 3 по 5", "от 3 до 5"
-        if allow_list_parsing:
+        if allow_list_parsing and len(digits) >= 2:
             nums: list[int] = []
-            for a, b in re.findall(r"(?:^|[\s,;])(?:с|от)?\s*(\d+)\s*(?:по|до)\s*(\d+)", q):
+            for a, b in _NUM_RANGE_WORDS_RE.findall(q):
                 nums.extend(self._expand_range(int(a), int(b)))
-            for a, b in re.findall(r"\b(\d+)\s*(?:-|–|—|\.\.)\s*(\d+)\b", q):
+            for a, b in _NUM_RANGE_DASH_RE.findall(q):
                 nums.extend(self._expand_range(int(a), int(b)))
             if nums:
                 nums = self._dedupe_ints(nums)
@@ -667,7 +946,7 @@ class WineAssistant:
                     return nums
 
         # Word ranges: "с третьей по пятую"
-        range_words = re.findall(r"(?:с|от)\s+([0-9а-яё-]+)\s+(?:по|до)\s+([0-9а-яё-]+)", q)
+        range_words = _WORD_RANGE_RE.findall(q)
         if allow_list_parsing and range_words:
             nums: list[int] = []
             for wa, wb in range_words:
@@ -682,16 +961,14 @@ class WineAssistant:
                 return nums
 
         # "1", "1 и 2", "1,2"
-        if re.fullmatch(r"[\d,\s;#№и\-]+", q):
-            nums = [int(x) for x in re.findall(r"\d+", q)]
-            nums = self._dedupe_ints(nums)
+        if _NUMBERS_ONLY_RE.fullmatch(q):
+            nums = self._dedupe_ints(digits)
             if max_n:
                 nums = [n for n in nums if 1 <= n <= max_n]
             return nums
 
         if allow_list_parsing and (list_ref or max_n):
-            nums = [int(x) for x in re.findall(r"\d+", q)]
-            words = re.findall(r"[а-яё-]+", q)
+            nums = list(digits)
             nums.extend(n for n in (self._ordinal_word_to_int(w) for w in words) if n)
             nums = self._dedupe_ints(nums)
             if max_n:
@@ -699,36 +976,33 @@ class WineAssistant:
             if nums:
                 return nums
 
-        if max_n and re.fullmatch(r"[а-яё,\s\-]+", q):
-            words = re.findall(r"[а-яё-]+", q)
+        if max_n and _CYRILLIC_ONLY_RE.fullmatch(q):
             nums = [n for n in (self._ordinal_word_to_int(w) for w in words) if n]
             nums = self._dedupe_ints(nums)
             nums = [n for n in nums if 1 <= n <= max_n]
             if nums:
                 return nums
 
-        if max_n and any(x in q for x in ("выбираю", "беру", "выбери", "выберу")):
-            m_num = re.search(r"\b(\d+)\s*(?:я|й)?\b", q)
+        if max_n and _CHOOSE_VERB_RE.search(q):
+            m_num = _CHOSEN_NUMBER_RE.search(q)
             if m_num:
                 n = int(m_num.group(1))
                 if 1 <= n <= max_n:
                     return [n]
-            words = re.findall(r"[а-яё-]+", q)
             for w in words:
                 n = self._ordinal_word_to_int(w)
                 if n and 1 <= n <= max_n:
                     return [n]
             return []
 
-        if self._has_list_reference_phrase(q):
-            nums = [int(x) for x in re.findall(r"\d+", q)]
-            nums = self._dedupe_ints(nums)
+        if list_ref:
+            nums = self._dedupe_ints(digits)
             if max_n:
                 nums = [n for n in nums if 1 <= n <= max_n]
             return nums
 
-        m = re.search(r"\b(\d+)\s*(?:я|й)?\b", q)
-        if m and any(x in q for x in ("выбираю", "беру")):
+        m = _CHOSEN_NUMBER_RE.search(q)
+        if m and _CHOSEN_VERB_RE.search(q):
             n = int(m.group(1))
             if max_n and not (1 <= n <= max_n):
                 return []
@@ -738,38 +1012,19 @@ class WineAssistant:
 
     @staticmethod
     def _dedupe_ints(values: list[int]) -> list[int]:
-        seen: set[int] = set()
-        out: list[int] = []
-        for v in values:
-            if v in seen:
-                continue
-            seen.add(v)
-            out.append(v)
-        return out
+        return list(dict.fromkeys(values))
 
-    def _extract_record_intent(self, text: str) -> str | None:
-        q = self._normalize_text(text)
+    @staticmethod
+    def _extract_record_intent(q: str) -> str | None:
         if "заметк" in q:
             return "note"
-        if any(m in q for m in ("лайк", "нравится", "понравил", "отметь", "отметк", "отметка")):
+        if _LIKE_INTENT_RE.search(q):
             return "like"
         return None
 
     @staticmethod
-    def _is_explicit_record_action(text: str) -> bool:
-        q = WineAssistant._normalize_text(text)
-        action_verbs = (
-            "постав",
-            "добав",
-            "сдела",
-            "созда",
-            "сохрани",
-            "запиши",
-            "отметь",
-            "лайкни",
-        )
-        record_words = ("лайк", "заметк", "отметк")
-        return any(v in q for v in action_verbs) and any(w in q for w in record_words)
+    def _is_explicit_record_action(q: str) -> bool:
+        return bool(_RECORD_ACTION_VERB_RE.search(q) and _RECORD_WORD_RE.search(q))
 
     def _extract_note_content(self, text: str) -> str | None:
         raw = str(text or "").strip()
@@ -777,7 +1032,7 @@ class WineAssistant:
             tail = raw.split(":", 1)[1].strip()
             if tail:
                 return tail
-        m = re.search(r"(?:текст заметки|заметка)\s+(.+)$", raw, flags=re.IGNORECASE)
+        m = _NOTE_CONTENT_RE.search(raw)
         if m:
             content = m.group(1).strip()
             if content:
@@ -787,13 +1042,8 @@ class WineAssistant:
     def _extract_wine_reference(self, text: str) -> str | None:
         raw = str(text or "").strip()
         before_colon = raw.split(":", 1)[0].strip()
-        patterns = [
-            r"(?:для|к)\s*вину?\s+(.+)$",
-            r"вину?\s+(.+)$",
-            r"вина\s+(.+)$",
-        ]
-        for p in patterns:
-            m = re.search(p, before_colon, flags=re.IGNORECASE)
+        for pattern in _WINE_REFERENCE_RES:
+            m = pattern.search(before_colon)
             if m:
                 ref = m.group(1).strip().strip('"').strip("'")
                 if ref:
@@ -808,12 +1058,27 @@ class WineAssistant:
         parts = [p for p in [name, producer, year] if p]
         return ", ".join(parts) if parts else "Без названия"
 
-    def _normalize_candidate(self, row: dict[str, Any]) -> dict[str, Any] | None:
+    def _prefetch_wine_briefs(self, rows: Iterable[Any]) -> dict[str, dict[str, Any] | None]:
+        # Карточки для всех строк одним запросом вместо get_wine_brief на каждую строку.
+        ids = []
+        for row in rows:
+            if isinstance(row, dict):
+                wine_id = str(row.get("wine_id") or row.get("card_key") or "").strip()
+                ids.append(wine_id or str(row.get("url") or "").strip())
+        briefs = self.db.get_wine_briefs_bulk(ids)
+        return {wine_id: briefs.get(wine_id) for wine_id in ids if wine_id}
+
+    def _normalize_candidate(
+        self,
+        row: dict[str, Any],
+        briefs: dict[str, dict[str, Any] | None] | None = None,
+    ) -> dict[str, Any] | None:
         wine_id = str(row.get("wine_id") or row.get("card_key") or "").strip()
         url = str(row.get("url") or "").strip()
         wine_name = str(row.get("wine_name") or row.get("title") or "").strip()
         producer = str(row.get("producer") or "").strip()
         harvest_year = row.get("harvest_year")
+        region = row.get("region")
 
         if not wine_id and url:
             wine_id = url
@@ -830,7 +1095,10 @@ class WineAssistant:
         if not wine_id:
             return None
 
-        brief = self.db.get_wine_brief(wine_id)
+        if briefs is not None and wine_id in briefs:
+            brief = briefs[wine_id]
+        else:
+            brief = self.db.get_wine_brief(wine_id)
         if brief is not None:
             wine_id = str(brief.get("card_key") or wine_id)
             if not wine_name:
@@ -841,24 +1109,29 @@ class WineAssistant:
                 harvest_year = brief.get("harvest_year")
             if not url:
                 url = str(brief.get("url") or "").strip()
-            if not row.get("region"):
-                row["region"] = brief.get("region")
+            if not region:
+                region = brief.get("region")
 
         return {
             "wine_id": wine_id,
             "wine_name": wine_name or None,
             "producer": producer or None,
             "harvest_year": harvest_year,
-            "region": row.get("region"),
+            "region": region,
             "url": url or None,
         }
 
     def _extract_wine_candidates_from_rows(self, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
         out: list[dict[str, Any]] = []
-        for row in rows[:200]:
+        # В кандидаты попадает не больше 30 строк: карточки заранее грузятся только для них,
+        # для редких пропущенных строк _normalize_candidate дочитает карточку сам.
+        # Дубли wine_id не выбрасываются: позиции должны совпадать с нумерацией показанного списка.
+        dict_rows = (row for row in islice(rows, 200) if isinstance(row, dict))
+        briefs = self._prefetch_wine_briefs(islice(dict_rows, 30))
+        for row in islice(rows, 200):
             if not isinstance(row, dict):
                 continue
-            normalized = self._normalize_candidate(row)
+            normalized = self._normalize_candidate(row, briefs)
             if not normalized:
                 continue
             out.append(normalized)
@@ -867,11 +1140,24 @@ class WineAssistant:
         return out
 
     def _search_wine_candidates(self, reference: str, limit: int = 7) -> list[dict[str, Any]]:
+        # Поиск по каталогу зависит только от текста ссылки (без учета регистра) и версии БД:
+        # повторы той же ссылки в диалоге (уточнения, выбор из списка) не ходят в SQLite.
+        cache_key = make_cache_key(
+            "search_wine_candidates",
+            str(reference or "").strip().lower(),
+            limit,
+            self.db.data_version(),
+        )
+        cached = self.tool_cache.get(cache_key)
+        if cached is not None:
+            return [dict(c) for c in cached]
+
         rows = self.db.search_wines_by_text(reference=reference, limit=limit)
         out: list[dict[str, Any]] = []
         seen: set[str] = set()
+        briefs = self._prefetch_wine_briefs(rows)
         for row in rows:
-            normalized = self._normalize_candidate(row)
+            normalized = self._normalize_candidate(row, briefs)
             if not normalized:
                 continue
             key = str(normalized.get("wine_id") or "")
@@ -879,6 +1165,7 @@ class WineAssistant:
                 continue
             seen.add(key)
             out.append(normalized)
+        self.tool_cache.set(cache_key, [dict(c) for c in out])
         return out
 
     def _format_candidates_prompt(
@@ -909,28 +1196,13 @@ class WineAssistant:
         return f"Заметка сохранена для вина: {label}.\nТекст заметки: {content or ''}"
 
     @staticmethod
-    def _is_my_records_request(text: str) -> bool:
-        q = WineAssistant._normalize_text(text)
-        markers = (
-            "мои отмет",
-            "мои лайк",
-            "мои замет",
-            "мои запис",
-            "покажи мои отмет",
-            "покажи мои лайк",
-            "покажи мои замет",
-            "покажи мои запис",
-        )
-        if any(m in q for m in markers):
+    def _is_my_records_request(q: str) -> bool:
+        if _MY_RECORDS_RE.search(q):
             return True
-        return bool(
-            re.search(r"\bмои\b", q)
-            and any(x in q for x in ("отмет", "лайк", "замет", "запис"))
-        )
+        return bool(_MY_WORD_RE.search(q) and _MY_RECORD_STEMS_RE.search(q))
 
     @staticmethod
-    def _extract_records_filter_type(text: str) -> str | None:
-        q = WineAssistant._normalize_text(text)
+    def _extract_records_filter_type(q: str) -> str | None:
         has_like = "лайк" in q
         has_note = "замет" in q
         if has_like and not has_note:
@@ -959,13 +1231,11 @@ class WineAssistant:
             type_label = "заметок"
         lines = [f"Найдено {len(rows)} ваших {type_label} (пользователь: {user})."]
 
-        brief_cache: dict[str, dict[str, Any] | None] = {}
         limit = 30
+        briefs = self.db.get_wine_briefs_bulk(row.get("wine_id") for row in rows[:limit])
         for idx, row in enumerate(rows[:limit], 1):
-            wine_id = str(row.get("wine_id") or "").strip()
-            if wine_id not in brief_cache:
-                brief_cache[wine_id] = self.db.get_wine_brief(wine_id) if wine_id else None
-            brief = brief_cache[wine_id] or {}
+            wine_id = _wine_id_of(row)
+            brief = briefs.get(wine_id) or {}
             label = self._format_wine_label(
                 {
                     "wine_name": brief.get("wine_name") or f"wine_id={wine_id}",
@@ -977,12 +1247,12 @@ class WineAssistant:
             kind = "лайк" if rec_type == "like" else "заметка"
             created = str(row.get("created_at") or "").strip()
             content = str(row.get("content") or "").strip()
-            line = f"{idx}. [{kind}] {label}"
+            parts = [f"{idx}. [{kind}] {label}"]
             if created:
-                line += f" | {created}"
+                parts.append(created)
             if rec_type == "note" and content:
-                line += f" | {content}"
-            lines.append(line)
+                parts.append(content)
+            lines.append(" | ".join(parts))
         if len(rows) > limit:
             lines.append(f"... и еще {len(rows) - limit}")
         return "\n".join(lines)
@@ -991,14 +1261,17 @@ class WineAssistant:
         self,
         user_text: str,
         public_user: str | None,
+        norm_text: str | None = None,
     ) -> tuple[str, dict[str, Any]] | None:
         if self.records_db is None:
             return None
-        if not self._is_my_records_request(user_text):
+        # Предикаты ниже принимают уже нормализованный текст.
+        q = norm_text if norm_text is not None else self._normalize_text(user_text)
+        if not self._is_my_records_request(q):
             return None
 
         user = str(public_user or "").strip() or "Гость"
-        record_type = self._extract_records_filter_type(user_text)
+        record_type = self._extract_records_filter_type(q)
         rows = self.records_db.list_records(user=user, record_type=record_type)
         answer = self._format_public_records_answer(rows=rows, user=user, record_type=record_type)
         return (
@@ -1024,40 +1297,42 @@ class WineAssistant:
         user_text: str,
         public_user: str | None,
         record_context: dict[str, Any] | None,
+        norm_text: str | None = None,
     ) -> tuple[str, dict[str, Any]] | None:
         if self.records_db is None:
             return None
 
         context = record_context or {}
-        pending = context.get("pending_record_action")
-        pending = pending if isinstance(pending, dict) else None
-
-        intent = self._extract_record_intent(user_text)
+        q = norm_text if norm_text is not None else self._normalize_text(user_text)
+        # Намерение нужно и при незавершенном действии: явное "лайк"/"заметка" переопределяет его тип.
+        intent = self._extract_record_intent(q)
+        raw_pending = context.get("pending_record_action")
+        if not intent and not raw_pending:
+            return None
+        pending = _PendingRecordAction.from_context(raw_pending)
         if not intent and not pending:
             return None
-        if intent and not pending and not self._is_explicit_record_action(user_text):
+        if intent and not pending and not self._is_explicit_record_action(q):
             return None
 
-        record_type = intent or str(pending.get("record_type") or "").strip()
+        record_type = intent or pending.record_type
         if record_type not in {"like", "note"}:
             return None
 
-        source_candidates = []
-        if pending and isinstance(pending.get("candidates"), list):
-            source_candidates = pending.get("candidates") or []
-        elif isinstance(context.get("last_wine_candidates"), list):
-            source_candidates = context.get("last_wine_candidates") or []
-
+        source_candidates = pending.candidates if pending else None
+        if source_candidates is None:
+            last_candidates = context.get("last_wine_candidates")
+            source_candidates = last_candidates if isinstance(last_candidates, list) else []
         source_candidates = [c for c in source_candidates if isinstance(c, dict)]
         pos_list = self._extract_position_refs(
             user_text,
             max_count=len(source_candidates) if source_candidates else None,
         )
-        has_list_ref = self._has_list_reference_phrase(self._normalize_text(user_text))
-        is_all_ref = self._is_all_positions_phrase(self._normalize_text(user_text))
+        has_list_ref = self._has_list_reference_phrase(q)
+        is_all_ref = self._is_all_positions_phrase(q)
         note_content = self._extract_note_content(user_text)
         if not note_content and pending and record_type == "note":
-            note_content = str(pending.get("content") or "").strip() or None
+            note_content = pending.content
 
         selected: dict[str, Any] | None = None
         selected_list: list[dict[str, Any]] = []
@@ -1099,16 +1374,17 @@ class WineAssistant:
                         "public_record_ops": [],
                     },
                 )
+            briefs = self._prefetch_wine_briefs([candidates[p - 1] for p in pos_list])
             for p in pos_list:
-                normalized = self._normalize_candidate(candidates[p - 1])
+                normalized = self._normalize_candidate(candidates[p - 1], briefs)
                 if normalized:
                     selected_list.append(normalized)
             if selected_list:
                 selected = selected_list[0]
         else:
             reference = self._extract_wine_reference(user_text)
-            if not reference and pending and str(pending.get("reference") or "").strip():
-                reference = str(pending.get("reference") or "").strip()
+            if not reference and pending and pending.reference:
+                reference = pending.reference
 
             if reference:
                 candidates = self._search_wine_candidates(reference, limit=7)
@@ -1116,23 +1392,34 @@ class WineAssistant:
                     selected = candidates[0]
                     selected_list = [candidates[0]]
                 elif len(candidates) > 1:
-                    return (
-                        self._format_candidates_prompt(
+                    pending_action = {
+                        "record_type": record_type,
+                        "content": note_content,
+                        "reference": reference,
+                        "candidates": candidates,
+                    }
+                    # Повтор того же уточнения (тот же список и параметры) отдает уже отрисованный prompt.
+                    prompt = pending.candidates_prompt if pending else None
+                    if prompt is None or (
+                        pending.record_type,
+                        pending.content,
+                        pending.reference,
+                        pending.candidates,
+                    ) != (record_type, note_content, reference, candidates):
+                        prompt = self._format_candidates_prompt(
                             candidates=candidates,
                             record_type=record_type,
                             note_content=note_content,
-                        ),
+                        )
+                    pending_action["candidates_prompt"] = prompt
+                    return (
+                        prompt,
                         {
                             "sql": None,
                             "rows": 0,
                             "model": self.model,
                             "public_record_ops": [],
-                            "set_pending_record_action": {
-                                "record_type": record_type,
-                                "content": note_content,
-                                "reference": reference,
-                                "candidates": candidates,
-                            },
+                            "set_pending_record_action": pending_action,
                         },
                     )
                 else:
@@ -1149,40 +1436,35 @@ class WineAssistant:
         if not selected_list and selected:
             selected_list = [selected]
 
-        if not selected_list and pending and isinstance(pending.get("selected_list"), list):
-            selected_list = [
-                c for c in pending.get("selected_list") or [] if isinstance(c, dict)
-            ]
+        if not selected_list and pending and pending.selected_list:
+            selected_list = pending.selected_list
 
-        if not selected and pending and isinstance(pending.get("selected"), dict):
-            selected = self._normalize_candidate(pending.get("selected") or {})
+        if not selected and pending and pending.selected is not None:
+            selected = self._normalize_candidate(pending.selected)
         if not selected and selected_list:
             selected = selected_list[0]
 
         if not selected:
             return None
 
-        bad_candidates = [c for c in selected_list if not str(c.get("wine_id") or "").strip()]
+        bad_candidates = [c for c in selected_list if not _wine_id_of(c)]
         if bad_candidates:
             return (
                 "Не удалось определить идентификатор одного из выбранных вин. Уточните запрос.",
                 {"sql": None, "rows": 0, "model": self.model, "public_record_ops": []},
             )
 
-        unique_selected_list: list[dict[str, Any]] = []
-        seen_ids: set[str] = set()
-        duplicate_selected_count = 0
+        # Первое вхождение каждой карточки; dict сохраняет порядок выбора.
+        unique_selected: dict[str, dict[str, Any]] = {}
+        selected_with_id = 0
         for cand in selected_list:
-            wine_id = str(cand.get("wine_id") or "").strip()
-            if not wine_id:
-                continue
-            if wine_id in seen_ids:
-                duplicate_selected_count += 1
-                continue
-            seen_ids.add(wine_id)
-            unique_selected_list.append(cand)
-        if unique_selected_list:
-            selected_list = unique_selected_list
+            wine_id = _wine_id_of(cand)
+            if wine_id:
+                selected_with_id += 1
+                unique_selected.setdefault(wine_id, cand)
+        duplicate_selected_count = selected_with_id - len(unique_selected)
+        if unique_selected:
+            selected_list = list(unique_selected.values())
             selected = selected_list[0]
 
         if record_type == "note" and not note_content:
@@ -1211,18 +1493,20 @@ class WineAssistant:
 
         saved_records: list[dict[str, Any]] = []
         errors: list[str] = []
-        for cand in selected_list:
-            wine_id = str(cand.get("wine_id") or "").strip()
-            try:
-                record = self.records_db.add_record(
-                    user=public_user,
-                    record_type=record_type,
-                    content=note_content if record_type == "note" else None,
-                    wine_id=wine_id,
-                )
-                saved_records.append(record)
-            except PublicRecordError as exc:
-                errors.append(f"{self._format_wine_label(cand)}: {exc}")
+        wine_ids = [_wine_id_of(cand) for cand in selected_list]
+        try:
+            saved_records, failed = self.records_db.add_records_bulk(
+                user=public_user,
+                record_type=record_type,
+                content=note_content if record_type == "note" else None,
+                wine_ids=wine_ids,
+            )
+        except PublicRecordError as exc:
+            failed = [(wine_id, exc) for wine_id in wine_ids]
+        failed_by_id = dict(failed)
+        for wine_id, cand in zip(wine_ids, selected_list):
+            if wine_id in failed_by_id:
+                errors.append(f"{self._format_wine_label(cand)}: {failed_by_id[wine_id]}")
 
         if not saved_records:
             return (
@@ -1268,7 +1552,7 @@ class WineAssistant:
             },
         )
 
-    def _build_messages(self, user_text: str, history: list[dict[str, str]]) -> list[dict[str, Any]]:
+    def _build_messages(self, user_text: str, history: Sequence[dict[str, str]]) -> list[dict[str, Any]]:
         msgs: list[dict[str, Any]] = [{"role": "system", "content": self.system_prompt}]
         if history:
             tail = history[-self.max_history_messages :]
@@ -1281,56 +1565,111 @@ class WineAssistant:
         return msgs
 
     def _tool_response(self, tool_call_args: str, include_full_rows: bool = False) -> dict[str, Any]:
-        try:
-            args = json.loads(tool_call_args or "{}")
-        except json.JSONDecodeError:
+        args = _parse_tool_args(tool_call_args)
+        if args is None:
             return {"ok": False, "error": "Невалидный JSON аргументов инструмента."}
 
         raw_query = str(args.get("query", "")).strip()
         if not raw_query:
             return {"ok": False, "error": "Пустой SQL query."}
 
-        t0 = time.perf_counter()
+        t0 = time.monotonic_ns()
+        # Каталог статичен: одинаковый SQL в пределах TTL отдается из кэша,
+        # смена файла БД (data_version) инвалидирует ключи.
+        cache_key = make_cache_key(
+            "execute_sql",
+            raw_query,
+            include_full_rows,
+            self.max_sql_rows,
+            self.max_rows_to_model,
+            self.db.data_version(),
+        )
+        cached = self.tool_cache.get(cache_key)
+        if cached is not None:
+            result = dict(cached)
+            result["rows"] = [dict(row) for row in cached["rows"]]
+            result["elapsed_ms"] = elapsed_ms(t0)
+            return result
         try:
-            safe_sql, rows = self.db.execute_safe_query(raw_query, max_rows=self.max_sql_rows)
-            limited_rows = rows[: self.max_rows_to_model]
+            if include_full_rows:
+                safe_sql, rows = self.db.execute_safe_query(raw_query, max_rows=self.max_sql_rows)
+                limited_rows = rows[: self.max_rows_to_model]
+                row_count = len(rows)
+            else:
+                # Модели уходят только первые max_rows_to_model строк: хвост не материализуем.
+                safe_sql, limited_rows, row_count = self.db.execute_safe_query_head(
+                    raw_query,
+                    max_rows=self.max_sql_rows,
+                    head_rows=self.max_rows_to_model,
+                )
             result = {
                 "ok": True,
                 "safe_sql": safe_sql,
-                "row_count": len(rows),
+                "row_count": row_count,
                 "rows": limited_rows,
-                "truncated_for_model": len(rows) > len(limited_rows),
-                "elapsed_ms": round((time.perf_counter() - t0) * 1000, 2),
+                "truncated_for_model": row_count > len(limited_rows),
+                "elapsed_ms": elapsed_ms(t0),
             }
             if include_full_rows:
+                # Полный список (до max_sql_rows строк) нужен один раз для ответа и в кэш не идет.
                 result["rows_full"] = rows
+            else:
+                # В кэше — своя копия строк без elapsed_ms: запись общая для потоков и запросов,
+                # поэтому ни кэш, ни вызывающий код не держат одни и те же dict строк.
+                cached = {k: v for k, v in result.items() if k != "elapsed_ms"}
+                cached["rows"] = [dict(row) for row in limited_rows]
+                self.tool_cache.set(cache_key, cached)
             return result
         except SQLValidationError as exc:
             return {
                 "ok": False,
                 "error": f"SQL отклонен: {exc}",
-                "elapsed_ms": round((time.perf_counter() - t0) * 1000, 2),
+                "elapsed_ms": elapsed_ms(t0),
             }
         except Exception as exc:
             return {
                 "ok": False,
                 "error": f"Ошибка выполнения SQL: {exc}",
-                "elapsed_ms": round((time.perf_counter() - t0) * 1000, 2),
+                "elapsed_ms": elapsed_ms(t0),
             }
 
     def _tool_web_response(self, tool_call_args: str) -> dict[str, Any]:
-        try:
-            args = json.loads(tool_call_args or "{}")
-        except json.JSONDecodeError:
+        args = _parse_tool_args(tool_call_args)
+        if args is None:
             return {"ok": False, "error": "Невалидный JSON аргументов инструмента."}
 
         query = str(args.get("query", "")).strip()
         max_results = int(args.get("max_results", 5) or 5)
-        t0 = time.perf_counter()
-        result = search_wine_web(query=query, max_results=max_results)
+        t0 = time.monotonic_ns()
+        result = self._search_web_cached(query, max_results)
         if isinstance(result, dict):
             result = dict(result)
-            result["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            result["elapsed_ms"] = elapsed_ms(t0)
+        return result
+
+    def _cache_answer(self, cache_key: str, answer: str, meta: dict[str, Any]) -> None:
+        # Ответы с операциями над публичными записями не кэшируются: у них есть побочные эффекты.
+        if meta.get("public_record_ops"):
+            return
+        # Ответ по web-результатам живет не дольше самих результатов с ценами и наличием.
+        ttl = None
+        if meta.get("web_results"):
+            ttl = min(_WEB_PRICE_CACHE_TTL_SEC, self.response_cache.ttl_sec)
+        self.response_cache.set(cache_key, (answer, meta), ttl_sec=ttl)
+
+    def _search_web_cached(self, query: str, max_results: int) -> dict[str, Any]:
+        # Общий кэш для tool-вызова и fallback-поиска: повторные запросы не идут в OpenAI.
+        cache_key = make_cache_key("search_web", query, max_results)
+        cached = self.tool_cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
+        result = search_wine_web(query=query, max_results=max_results)
+        if isinstance(result, dict) and result.get("ok"):
+            # Цены и наличие меняются быстрее остальной web-информации.
+            ttl = None
+            if self._is_price_or_availability_request(query):
+                ttl = min(_WEB_PRICE_CACHE_TTL_SEC, self.tool_cache.ttl_sec)
+            self.tool_cache.set(cache_key, dict(result), ttl_sec=ttl)
         return result
 
     def _tool_public_add_response(
@@ -1341,9 +1680,8 @@ class WineAssistant:
         if self.records_db is None:
             return {"ok": False, "error": "Public records DB не подключена."}
 
-        try:
-            args = json.loads(tool_call_args or "{}")
-        except json.JSONDecodeError:
+        args = _parse_tool_args(tool_call_args)
+        if args is None:
             return {"ok": False, "error": "Невалидный JSON аргументов инструмента."}
 
         wine_id = str(args.get("wine_id", "")).strip()
@@ -1368,9 +1706,8 @@ class WineAssistant:
         if self.records_db is None:
             return {"ok": False, "error": "Public records DB не подключена."}
 
-        try:
-            args = json.loads(tool_call_args or "{}")
-        except json.JSONDecodeError:
+        args = _parse_tool_args(tool_call_args)
+        if args is None:
             return {"ok": False, "error": "Невалидный JSON аргументов инструмента."}
 
         wine_id = str(args.get("wine_id", "")).strip() or None
@@ -1393,9 +1730,8 @@ class WineAssistant:
         if self.records_db is None:
             return {"ok": False, "error": "Public records DB не подключена."}
 
-        try:
-            args = json.loads(tool_call_args or "{}")
-        except json.JSONDecodeError:
+        args = _parse_tool_args(tool_call_args)
+        if args is None:
             return {"ok": False, "error": "Невалидный JSON аргументов инструмента."}
 
         wine_id = str(args.get("wine_id", "")).strip()
@@ -1410,15 +1746,142 @@ class WineAssistant:
         except Exception as exc:
             return {"ok": False, "error": f"Ошибка get_wine_public_summary: {exc}"}
 
+    def _execute_tool_call(
+        self,
+        tool_call: Any,
+        force_full: bool = False,
+        public_user: str | None = None,
+    ) -> dict[str, Any]:
+        name = tool_call.function.name
+        handler = self._tool_handlers.get(name)
+        if handler is None:
+            return {"ok": False, "error": f"Неизвестный инструмент: {name}"}
+        return handler(tool_call.function.arguments, force_full, public_user)
+
+    def _run_tool_calls(
+        self,
+        tool_calls: list[Any],
+        force_full: bool = False,
+        public_user: str | None = None,
+    ) -> Iterator[dict[str, Any]]:
+        def run(tool_call: Any) -> dict[str, Any]:
+            return self._execute_tool_call(tool_call, force_full=force_full, public_user=public_user)
+
+        # Независимые чтения (SQL, web, списки записей) одного шага LLM выполняются параллельно.
+        # Полный список остается последовательным: там важен ранний выход после первого SQL.
+        if len(tool_calls) < 2 or force_full:
+            return (run(tc) for tc in tool_calls)
+        if not any(tc.function.name in _SEQUENTIAL_TOOLS for tc in tool_calls):
+            return self._tool_executor.map(run, tool_calls)
+        # Добавление записей идет строго по порядку вместе с чтением записей, а запросы
+        # к каталогу и web от записей не зависят и стартуют сразу.
+        futures = {
+            idx: self._tool_executor.submit(run, tc)
+            for idx, tc in enumerate(tool_calls)
+            if tc.function.name in _CATALOG_TOOLS
+        }
+        return (
+            futures[idx].result() if idx in futures else run(tc)
+            for idx, tc in enumerate(tool_calls)
+        )
+
+    def _stream_completion(
+        self,
+        model: str,
+        messages: list[Any],
+        streamer: "_AnswerSanitizer",
+    ) -> Iterator[tuple[Any, ...]]:
+        stream = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            tools=self.tools,
+            temperature=0,
+            max_completion_tokens=self.max_completion_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        content_parts: list[str] = []
+        calls: dict[int, dict[str, str]] = {}
+        usage = None
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            for tc in delta.tool_calls or ():
+                slot = calls.setdefault(tc.index, {"id": "", "name": "", "arguments": ""})
+                if tc.id:
+                    slot["id"] = tc.id
+                if tc.function is not None:
+                    slot["name"] += tc.function.name or ""
+                    slot["arguments"] += tc.function.arguments or ""
+            if delta.content:
+                content_parts.append(delta.content)
+                # Текст шага с вызовом инструментов не является ответом: перестаем его отдавать.
+                if not calls:
+                    text = streamer.feed(delta.content)
+                    if text:
+                        yield "delta", text
+
+        content = "".join(content_parts) or None
+        tool_calls = [
+            SimpleNamespace(
+                id=slot["id"],
+                function=SimpleNamespace(name=slot["name"], arguments=slot["arguments"]),
+            )
+            for _, slot in sorted(calls.items())
+        ]
+        msg = SimpleNamespace(content=content, tool_calls=tool_calls or None)
+        history_item: dict[str, Any] = {"role": "assistant", "content": content}
+        if tool_calls:
+            history_item["tool_calls"] = [
+                {
+                    "id": tc.id,
+                    "type": "function",
+                    "function": {"name": tc.function.name, "arguments": tc.function.arguments},
+                }
+                for tc in tool_calls
+            ]
+        return msg, usage, history_item
+
     def ask(
         self,
         user_text: str,
-        history: list[dict[str, str]] | None = None,
+        history: Sequence[dict[str, str]] | None = None,
         public_user: str | None = None,
         record_context: dict[str, Any] | None = None,
     ) -> tuple[str, dict[str, Any]]:
-        started_at = time.perf_counter()
-        selected_model = self._select_model_for_query(user_text)
+        answer, meta = "", {}
+        for event in self._ask_events(user_text, history, public_user, record_context, stream=False):
+            if event[0] == "done":
+                _, answer, meta = event
+        return answer, meta
+
+    def ask_stream(
+        self,
+        user_text: str,
+        history: Sequence[dict[str, str]] | None = None,
+        public_user: str | None = None,
+        record_context: dict[str, Any] | None = None,
+    ) -> Iterator[tuple[Any, ...]]:
+        # События: ("delta", text) — очищенные фрагменты ответа по мере генерации,
+        # ("done", answer, meta) — итоговый ответ; он авторитетен и заменяет собранные delta.
+        return self._ask_events(user_text, history, public_user, record_context, stream=True)
+
+    def _ask_events(
+        self,
+        user_text: str,
+        history: Sequence[dict[str, str]] | None,
+        public_user: str | None,
+        record_context: dict[str, Any] | None,
+        stream: bool,
+    ) -> Iterator[tuple[Any, ...]]:
+        started_at = time.monotonic_ns()
+        # Нормализованный текст и признаки запроса считаются один раз на реплику.
+        text_class = _classify_text(user_text)
+        norm_text = text_class.norm_text
+        selected_model = self._select_model_for_query(user_text, text_class.is_complex)
         perf = {
             "selected_model": selected_model,
             "llm_rounds": 0,
@@ -1434,22 +1897,22 @@ class WineAssistant:
             "web_query_ms_total": 0.0,
             "fallback_web_calls": 0,
             "fallback_web_ms_total": 0.0,
+            "response_cache_hit": False,
         }
 
+        # Вызывается ровно один раз, в финальном "done": счетчики дальше не меняются,
+        # поэтому perf отдается в meta без копии.
         def attach_perf(meta: dict[str, Any]) -> dict[str, Any]:
             out = dict(meta or {})
-            perf_total = dict(perf)
-            perf_total["total_ms"] = round((time.perf_counter() - started_at) * 1000, 2)
-            if perf_total["llm_rounds"] > 0:
-                perf_total["llm_wait_ms_avg"] = round(
-                    perf_total["llm_wait_ms_total"] / perf_total["llm_rounds"],
-                    2,
-                )
-            out["perf"] = perf_total
+            perf["total_ms"] = elapsed_ms(started_at)
+            if perf["llm_rounds"] > 0:
+                perf["llm_wait_ms_avg"] = round(perf["llm_wait_ms_total"] / perf["llm_rounds"], 2)
+            out["perf"] = perf
             return out
 
-        if self._is_capabilities_request(user_text):
-            return (
+        if text_class.is_capabilities:
+            yield (
+                "done",
                 self.capabilities_text,
                 attach_perf({
                     "sql": None,
@@ -1462,26 +1925,32 @@ class WineAssistant:
                     "info_source": "SYSTEM_CAPABILITIES.md",
                 }),
             )
+            return
 
         contextual_record = self._handle_contextual_record_intent(
             user_text=user_text,
             public_user=public_user,
             record_context=record_context,
+            norm_text=norm_text,
         )
         if contextual_record is not None:
             answer, meta = contextual_record
-            return self._sanitize_public_answer(answer), attach_perf(meta)
+            yield "done", self._sanitize_public_answer(answer), attach_perf(meta)
+            return
 
         my_records = self._handle_my_records_request(
             user_text=user_text,
             public_user=public_user,
+            norm_text=norm_text,
         )
         if my_records is not None:
             answer, meta = my_records
-            return self._sanitize_public_answer(answer), attach_perf(meta)
+            yield "done", self._sanitize_public_answer(answer), attach_perf(meta)
+            return
 
         if not self.client:
-            return (
+            yield (
+                "done",
                 "OpenAI недоступен: проверьте установку пакета `openai` и переменную OPENAI_API_KEY.",
                 attach_perf({
                     "sql": None,
@@ -1494,14 +1963,32 @@ class WineAssistant:
                     "model": selected_model,
                 }),
             )
+            return
 
         messages = self._build_messages(user_text, history or [])
+        force_full = text_class.is_full_list
+        # Ключ учитывает модель, нормализованный текст, набор инструментов, историю, ушедшую в LLM,
+        # и версию файла каталога: после обновления БД ответы строятся заново.
+        cache_key = make_cache_key(
+            self.db.data_version(),
+            selected_model,
+            norm_text,
+            force_full,
+            self._tool_names,
+            [f"{m['role']}:{m['content']}" for m in messages[1:-1]],
+        )
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            answer, meta = cached
+            perf["response_cache_hit"] = True
+            yield "done", answer, attach_perf(meta)
+            return
+
         last_sql = None
         last_rows = 0
-        force_full = self._is_full_list_request(user_text)
         sql_queries: list[str] = []
         web_queries: list[str] = []
-        web_results: list[dict[str, Any]] = []
+        web_hits: dict[str, dict[str, Any]] = {}
         web_tool_logs: list[dict[str, Any]] = []
         public_record_ops: list[dict[str, Any]] = []
         latest_wine_candidates: list[dict[str, Any]] = []
@@ -1519,30 +2006,39 @@ class WineAssistant:
                     total += len(content)
                 elif content is not None:
                     try:
-                        total += len(json.dumps(content, ensure_ascii=False))
+                        total += len(fast_json.dumps(content))
                     except Exception:
                         total += len(str(content))
                 if isinstance(tool_calls, list):
                     try:
-                        total += len(json.dumps(tool_calls, ensure_ascii=False))
+                        total += len(fast_json.dumps(tool_calls))
                     except Exception:
                         total += len(str(tool_calls))
             return total
 
         for _ in range(3):
             perf["llm_input_chars_total"] += _messages_char_size(messages)
-            llm_t0 = time.perf_counter()
-            completion = self.client.chat.completions.create(
-                model=selected_model,
-                messages=messages,
-                tools=self.tools,
-                temperature=0,
-                max_completion_tokens=self.max_completion_tokens,
-            )
+            llm_t0 = time.monotonic_ns()
+            if stream:
+                streamer = _AnswerSanitizer()
+                msg, usage, history_item = yield from self._stream_completion(
+                    selected_model,
+                    messages,
+                    streamer,
+                )
+            else:
+                completion = self.client.chat.completions.create(
+                    model=selected_model,
+                    messages=messages,
+                    tools=self.tools,
+                    temperature=0,
+                    max_completion_tokens=self.max_completion_tokens,
+                )
+                msg = completion.choices[0].message
+                usage = getattr(completion, "usage", None)
+                history_item = msg
             perf["llm_rounds"] += 1
-            perf["llm_wait_ms_total"] += (time.perf_counter() - llm_t0) * 1000
-            msg = completion.choices[0].message
-            usage = getattr(completion, "usage", None)
+            perf["llm_wait_ms_total"] += elapsed_ms(llm_t0)
             if usage is not None:
                 perf["llm_prompt_tokens_total"] += int(getattr(usage, "prompt_tokens", 0) or 0)
                 perf["llm_completion_tokens_total"] += int(
@@ -1556,15 +2052,19 @@ class WineAssistant:
             perf["llm_output_chars_total"] += output_chars
 
             if not msg.tool_calls:
+                if stream:
+                    tail = streamer.finish()
+                    if tail:
+                        yield "delta", tail
                 answer = msg.content or "Не удалось сформировать ответ."
-                if self.web_tool_enabled and not web_results and (
+                if self.web_tool_enabled and not web_hits and (
                     self._is_price_or_availability_request(user_text)
                     or (last_rows == 0 and self._looks_like_wine_name_or_topic(user_text))
                 ):
-                    fallback_t0 = time.perf_counter()
-                    fallback = search_wine_web(query=user_text, max_results=5)
+                    fallback_t0 = time.monotonic_ns()
+                    fallback = self._search_web_cached(user_text.strip(), 5)
                     perf["fallback_web_calls"] += 1
-                    perf["fallback_web_ms_total"] += (time.perf_counter() - fallback_t0) * 1000
+                    perf["fallback_web_ms_total"] += elapsed_ms(fallback_t0)
                     fallback_results = fallback.get("results") or []
                     fallback_log = {
                         "source": "fallback",
@@ -1589,30 +2089,31 @@ class WineAssistant:
                         q = fallback.get("search_query") or fallback.get("query")
                         if q:
                             web_queries.append(str(q))
-                        if isinstance(fallback_results, list):
-                            web_results.extend([x for x in fallback_results if isinstance(x, dict)])
+                        self._merge_web_results(web_hits, fallback_results)
 
                 answer = self._sanitize_public_answer(answer)
-                return answer, attach_perf({
+                meta = {
                     "sql": last_sql,
                     "sql_queries": sql_queries,
                     "web_queries": web_queries,
-                    "web_results": self._dedupe_web_results(web_results)[:10],
+                    "web_results": list(islice(web_hits.values(), 10)),
                     "web_tool_logs": web_tool_logs,
                     "public_record_ops": public_record_ops,
                     "wine_context_candidates": latest_wine_candidates,
                     "rows": last_rows,
                     "model": selected_model,
-                })
-
-            messages.append(msg)
-            for tool_call in msg.tool_calls:
+                }
+                self._cache_answer(cache_key, answer, meta)
+                yield "done", answer, attach_perf(meta)
+                return
+
+            messages.append(history_item)
+            tool_calls = list(msg.tool_calls)
+            step_results = self._run_tool_calls(tool_calls, force_full=force_full, public_user=public_user)
+            for tool_call, tool_result in zip(tool_calls, step_results):
                 perf["tool_calls_total"] += 1
-                if tool_call.function.name == "execute_sql":
-                    tool_result = self._tool_response(
-                        tool_call.function.arguments,
-                        include_full_rows=force_full,
-                    )
+                tool_name = tool_call.function.name
+                if tool_name == "execute_sql":
                     perf["db_tool_calls"] += 1
                     perf["db_query_ms_total"] += float(tool_result.get("elapsed_ms") or 0.0)
                     if tool_result.get("ok"):
@@ -1620,9 +2121,8 @@ class WineAssistant:
                         last_rows = int(tool_result.get("row_count", 0))
                         source_rows = tool_result.get("rows_full") if force_full else tool_result.get("rows")
                         if isinstance(source_rows, list):
-                            extracted = self._extract_wine_candidates_from_rows(
-                                [r for r in source_rows if isinstance(r, dict)]
-                            )
+                            # Строки SQL уже dict; не-dict строки пропускает сам экстрактор.
+                            extracted = self._extract_wine_candidates_from_rows(source_rows)
                             if extracted:
                                 latest_wine_candidates = extracted
                         if last_sql:
@@ -1631,19 +2131,21 @@ class WineAssistant:
                             rows_full = tool_result.get("rows_full", [])
                             answer = self._format_full_list_answer(rows_full)
                             answer = self._sanitize_public_answer(answer)
-                            return answer, attach_perf({
+                            meta = {
                                 "sql": last_sql,
                                 "sql_queries": sql_queries,
                                 "web_queries": web_queries,
-                                "web_results": self._dedupe_web_results(web_results)[:10],
+                                "web_results": list(islice(web_hits.values(), 10)),
                                 "web_tool_logs": web_tool_logs,
                                 "public_record_ops": public_record_ops,
                                 "wine_context_candidates": latest_wine_candidates,
                                 "rows": last_rows,
                                 "model": selected_model,
-                            })
-                elif tool_call.function.name == "search_web":
-                    tool_result = self._tool_web_response(tool_call.function.arguments)
+                            }
+                            self._cache_answer(cache_key, answer, meta)
+                            yield "done", answer, attach_perf(meta)
+                            return
+                elif tool_name == "search_web":
                     perf["web_tool_calls"] += 1
                     perf["web_query_ms_total"] += float(tool_result.get("elapsed_ms") or 0.0)
                     q = None
@@ -1670,60 +2172,34 @@ class WineAssistant:
                     )
                     if tool_result.get("ok"):
                         q = tool_result.get("search_query") or tool_result.get("query")
-                        if isinstance(tool_results, list):
-                            web_results.extend([x for x in tool_results if isinstance(x, dict)])
+                        self._merge_web_results(web_hits, tool_results)
                     if q:
                         web_queries.append(str(q))
-                elif tool_call.function.name == "add_public_record":
-                    tool_result = self._tool_public_add_response(
-                        tool_call.function.arguments,
-                        default_user=public_user,
-                    )
-                    public_record_ops.append(
-                        {
-                            "op": "add_public_record",
-                            "ok": bool(tool_result.get("ok")),
-                            "error": tool_result.get("error"),
-                            "record": tool_result.get("record"),
-                        }
-                    )
-                elif tool_call.function.name == "list_public_records":
-                    tool_result = self._tool_public_list_response(tool_call.function.arguments)
-                    public_record_ops.append(
-                        {
-                            "op": "list_public_records",
-                            "ok": bool(tool_result.get("ok")),
-                            "error": tool_result.get("error"),
-                            "count": int(tool_result.get("count") or 0),
-                        }
-                    )
-                elif tool_call.function.name == "get_wine_public_summary":
-                    tool_result = self._tool_public_summary_response(tool_call.function.arguments)
+                elif tool_name in _PUBLIC_RECORD_OP_FIELDS:
                     public_record_ops.append(
                         {
-                            "op": "get_wine_public_summary",
+                            "op": tool_name,
                             "ok": bool(tool_result.get("ok")),
                             "error": tool_result.get("error"),
-                            "summary": tool_result.get("summary"),
+                            **_PUBLIC_RECORD_OP_FIELDS[tool_name](tool_result),
                         }
                     )
-                else:
-                    tool_result = {"ok": False, "error": f"Неизвестный инструмент: {tool_call.function.name}"}
                 messages.append(
                     {
                         "role": "tool",
                         "tool_call_id": tool_call.id,
-                        "content": json.dumps(tool_result, ensure_ascii=False),
+                        "content": fast_json.dumps(tool_result),
                     }
                 )
 
-        return (
+        yield (
+            "done",
             "Не удалось завершить обработку запроса за допустимое число шагов.",
             attach_perf({
                 "sql": last_sql,
                 "sql_queries": sql_queries,
                 "web_queries": web_queries,
-                "web_results": self._dedupe_web_results(web_results)[:10],
+                "web_results": list(islice(web_hits.values(), 10)),
                 "web_tool_logs": web_tool_logs,
                 "public_record_ops": public_record_ops,
                 "wine_context_candidates": latest_wine_candidates,
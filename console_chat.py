@@ -2,6 +2,7 @@ import os
 import csv
 from datetime import datetime
 from pathlib import Path
+from typing import Any, Iterable, Iterator, Sequence
 
 from dotenv import find_dotenv, load_dotenv
 
@@ -12,24 +13,34 @@ from public_records_db import PublicRecordsDB
 load_dotenv(find_dotenv())
 
 
-def save_rows_to_csv(rows: list[dict], out_path: Path) -> Path | None:
-    if not rows:
-        return None
+class _RowCounter:
+    # Считает строки, пока csv.writer.writerows забирает их из курсора.
+    def __init__(self, rows: Iterable[Sequence[Any]]):
+        self._rows = rows
+        self.count = 0
 
-    columns: list[str] = list(rows[0].keys())
-    for row in rows[1:]:
-        for key in row.keys():
-            if key not in columns:
-                columns.append(key)
+    def __iter__(self) -> Iterator[Sequence[Any]]:
+        for row in self._rows:
+            self.count += 1
+            yield row
+
+
+def save_rows_to_csv(columns: list[str], rows: Iterable[Sequence[Any]], out_path: Path) -> int:
+    it = iter(rows)
+    first = next(it, None)
+    if first is None:
+        return 0
 
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+    counted = _RowCounter(it)
+    with out_path.open("w", newline="", encoding="utf-8-sig", buffering=4 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerow(first)
+        # Строки пишутся прямо из курсора, без промежуточных dict.
+        writer.writerows(counted)
 
-    return out_path
+    return counted.count + 1
 
 
 def build_csv_filename(prefix: str = "query_result") -> str:
@@ -38,15 +49,7 @@ def build_csv_filename(prefix: str = "query_result") -> str:
 
 
 def dedupe_keep_order(items: list[str]) -> list[str]:
-    seen: set[str] = set()
-    result: list[str] = []
-    for item in items:
-        key = str(item).strip()
-        if not key or key in seen:
-            continue
-        seen.add(key)
-        result.append(key)
-    return result
+    return list(dict.fromkeys(key for key in (str(item).strip() for item in items) if key))
 
 
 def print_web_tool_logs(logs: list[dict]) -> None:
@@ -179,12 +182,28 @@ def main() -> None:
             print(f"Папка для CSV: {csv_dir}")
             continue
 
-        answer, meta = assistant.ask(
+        # Ответ печатается по мере генерации; итоговый текст из "done" авторитетен
+        # и выводится заново, только если отличается от напечатанных фрагментов.
+        print("\nБот> ", end="", flush=True)
+        streamed: list[str] = []
+        answer, meta = "", {}
+        for event in assistant.ask_stream(
             user_text,
             history=history,
             public_user="Гость",
             record_context=context_state,
-        )
+        ):
+            if event[0] == "delta":
+                streamed.append(event[1])
+                print(event[1], end="", flush=True)
+            elif event[0] == "done":
+                _, answer, meta = event
+        if not streamed:
+            print(answer)
+        elif "".join(streamed).strip() != answer.strip():
+            print(f"\n\nБот> {answer}")
+        else:
+            print()
         candidates = meta.get("wine_context_candidates")
         if isinstance(candidates, list) and candidates:
             context_state["last_wine_candidates"] = candidates[:30]
@@ -197,11 +216,9 @@ def main() -> None:
         history.append({"role": "user", "content": user_text})
         history.append({"role": "assistant", "content": answer})
 
-        print(f"\nБот> {answer}")
+        sql = meta.get("sql")
+        sql_queries = dedupe_keep_order(meta.get("sql_queries") or ([] if not sql else [sql]))
         if show_sql:
-            sql = meta.get("sql")
-            sql_queries = meta.get("sql_queries") or ([] if not sql else [sql])
-            sql_queries = dedupe_keep_order(sql_queries)
             web_queries = dedupe_keep_order(meta.get("web_queries") or [])
             rows = meta.get("rows")
             model = meta.get("model")
@@ -225,21 +242,19 @@ def main() -> None:
         if show_web_log:
             print_web_tool_logs(meta.get("web_tool_logs") or [])
 
-        sql_queries = meta.get("sql_queries") or ([] if not meta.get("sql") else [meta.get("sql")])
-        sql_queries = dedupe_keep_order(sql_queries)
         if csv_mode and sql_queries:
             try:
                 if len(sql_queries) > 1:
                     print(f"[csv] Найдено SQL-запросов для экспорта: {len(sql_queries)}")
 
                 for i, sql_item in enumerate(sql_queries, 1):
-                    _, rows_data = db.execute_safe_query(str(sql_item), max_rows=50000)
                     prefix = "query_result" if len(sql_queries) == 1 else f"query_result_q{i:02d}"
                     csv_path = csv_dir / build_csv_filename(prefix=prefix)
                     print(f"[csv] Начинаю запись результатов в файл: {csv_path}")
-                    written = save_rows_to_csv(rows_data, csv_path)
+                    with db.stream_safe_query(str(sql_item), max_rows=50000) as (_, columns, cursor):
+                        written = save_rows_to_csv(columns, cursor, csv_path)
                     if written:
-                        print(f"[csv] Запись завершена. Строк: {len(rows_data)}. Файл: {written}")
+                        print(f"[csv] Запись завершена. Строк: {written}. Файл: {csv_path}")
                     else:
                         print("[csv] Запрос не вернул строк, файл не создан.")
             except Exception as exc:
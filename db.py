@@ -1,8 +1,11 @@
+import contextlib
 import json
 import functools
+import queue
 import re
 import sqlite3
 from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
 
 from sql_guard import build_safe_sql
 
@@ -37,6 +40,8 @@ LIKE_EXPR_RE = re.compile(
     flags=re.IGNORECASE | re.VERBOSE,
 )
 
+_REFERENCE_TOKEN_RE = re.compile(r"[0-9a-zа-яё]+")
+
 
 @functools.lru_cache(maxsize=2048)
 def _compile_like_regex(pattern_cf: str, escape_char: str) -> re.Pattern[str]:
@@ -91,28 +96,125 @@ def rewrite_like_to_ru_like(sql: str) -> str:
     return LIKE_EXPR_RE.sub(repl, text)
 
 
+READ_PRAGMAS = (
+    "PRAGMA query_only=1",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+@functools.lru_cache(maxsize=512)
+def _prepare_safe_sql(raw_sql: str, max_rows: int) -> tuple[str, str]:
+    # LLM часто повторяет один и тот же SQL, а консоль перезапускает его для CSV:
+    # проверка и переписывание LIKE кэшируются (ошибки валидации lru_cache не запоминает).
+    safe_sql = build_safe_sql(raw_sql, max_rows=max_rows)
+    return safe_sql, rewrite_like_to_ru_like(safe_sql)
+
+
+class ConnectionPool:
+    def __init__(self, factory: Callable[[], sqlite3.Connection], size: int = 4):
+        self._factory = factory
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(maxsize=max(1, int(size)))
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._factory()
+        try:
+            yield conn
+        finally:
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
 class WineDB:
-    def __init__(self, db_path: str | Path, table_name: str = "wine_cards_wide"):
+    def __init__(self, db_path: str | Path, table_name: str = "wine_cards_wide", pool_size: int = 4):
         self.db_path = Path(db_path).resolve()
         self.table_name = table_name
         if not self.db_path.exists():
             raise FileNotFoundError(f"SQLite файл не найден: {self.db_path}")
+        self._pool = ConnectionPool(self._connect_ro, size=pool_size)
+        self._meta_cache: dict[str, tuple[int, Any]] = {}
+        # Тексты частых запросов собираются один раз: одна и та же строка SQL
+        # берется из кэша подготовленных выражений sqlite3 без повторного разбора.
+        self._sql_wine_brief = f"""
+            SELECT
+                card_key, wine_name, producer, harvest_year, region, rating_year, rating_points, url
+            FROM {table_name}
+            WHERE CAST(card_key AS TEXT) = ?
+               OR url = ?
+            ORDER BY rating_year DESC, rating_points DESC, harvest_year DESC
+            LIMIT 1
+        """
+        self._sql_resolve_wine_id = {
+            (with_producer, with_year): self._build_resolve_wine_id_sql(with_producer, with_year)
+            for with_producer in (False, True)
+            for with_year in (False, True)
+        }
 
     def _connect_ro(self) -> sqlite3.Connection:
         uri = f"file:{self.db_path.as_posix()}?mode=ro"
-        conn = sqlite3.connect(uri, uri=True)
+        conn = sqlite3.connect(
+            uri,
+            uri=True,
+            timeout=5.0,
+            check_same_thread=False,
+            cached_statements=256,
+            isolation_level=None,
+        )
         conn.row_factory = sqlite3.Row
+        for pragma in READ_PRAGMAS:
+            conn.execute(pragma)
         conn.create_function("RU_LIKE", 2, _ru_like, deterministic=True)
         conn.create_function("RU_LIKE", 3, _ru_like_escape, deterministic=True)
         return conn
 
+    def _read_conn(self) -> contextlib.AbstractContextManager[sqlite3.Connection]:
+        return self._pool.connection()
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def data_version(self) -> int:
+        # Меняется при обновлении файла каталога: по нему инвалидируются кэши результатов.
+        try:
+            return self.db_path.stat().st_mtime_ns
+        except OSError:
+            return 0
+
     def ping(self) -> bool:
-        with self._connect_ro() as conn:
+        with self._read_conn() as conn:
             conn.execute("SELECT 1").fetchone()
         return True
 
+    def _cached_meta(self, name: str, build: Callable[[], Any]) -> Any:
+        # Схема и справочники меняются только вместе с файлом каталога: перечитываем их по data_version.
+        version = self.data_version()
+        entry = self._meta_cache.get(name)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = build()
+        self._meta_cache[name] = (version, value)
+        return value
+
     def get_columns(self) -> list[str]:
-        with self._connect_ro() as conn:
+        return list(self._cached_meta("columns", self._read_columns))
+
+    def _read_columns(self) -> list[str]:
+        with self._read_conn() as conn:
             rows = conn.execute(f"PRAGMA table_info({self.table_name})").fetchall()
         return [row["name"] for row in rows]
 
@@ -121,7 +223,7 @@ class WineDB:
         return f"Table: {self.table_name}\nColumns: {', '.join(cols)}"
 
     def get_distinct_values(self, column: str) -> list[str]:
-        with self._connect_ro() as conn:
+        with self._read_conn() as conn:
             rows = conn.execute(
                 f"""
                 SELECT DISTINCT {column}
@@ -134,6 +236,10 @@ class WineDB:
         return [str(r[0]) for r in rows]
 
     def get_reference_values(self) -> dict[str, list[str]]:
+        refs = self._cached_meta("reference_values", self._read_reference_values)
+        return {name: list(values) for name, values in refs.items()}
+
+    def _read_reference_values(self) -> dict[str, list[str]]:
         refs = {
             "wine_color": self.get_distinct_values("wine_color"),
             "sugar_style": self.get_distinct_values("sugar_style"),
@@ -145,29 +251,44 @@ class WineDB:
         # recommendations в wide-колонке строка через запятую, но внутри терминов
         # возможны запятые ("..., барбекю"). Берем исходный raw из row_json и
         # разбираем по первичному разделителю ";".
+        # Строковое значение достает json_extract на стороне SQLite, а DISTINCT схлопывает
+        # повторы: в Python разбираются только уникальные значения. Нетиповые строки
+        # (невалидный JSON, не строка) идут прежним путем через json.loads.
         terms: set[str] = set()
-        with self._connect_ro() as conn:
+        with self._read_conn() as conn:
             rows = conn.execute(
                 f"""
-                SELECT row_json, recommendations
-                FROM {self.table_name}
+                SELECT DISTINCT
+                    CASE WHEN is_text THEN json_extract(row_json, '$.recommendations') END AS raw_rec,
+                    CASE WHEN is_text THEN NULL ELSE row_json END AS row_json,
+                    recommendations
+                FROM (
+                    SELECT
+                        row_json,
+                        recommendations,
+                        CASE
+                            WHEN json_valid(row_json)
+                            THEN json_type(row_json, '$.recommendations') = 'text'
+                            ELSE 0
+                        END AS is_text
+                    FROM {self.table_name}
+                )
                 """
             ).fetchall()
         for row in rows:
-            parsed = False
-            try:
-                raw = json.loads(row["row_json"])
-                raw_rec = str(raw.get("recommendations", "")).strip()
-                if raw_rec:
-                    for item in raw_rec.split(";"):
-                        value = item.strip()
-                        if value:
-                            terms.add(value)
-                    parsed = True
-            except Exception:
-                parsed = False
-
-            if not parsed:
+            raw_rec = row["raw_rec"]
+            if raw_rec is None:
+                try:
+                    raw_rec = str(json.loads(row["row_json"]).get("recommendations", ""))
+                except Exception:
+                    raw_rec = ""
+            raw_rec = raw_rec.strip()
+            if raw_rec:
+                for item in raw_rec.split(";"):
+                    value = item.strip()
+                    if value:
+                        terms.add(value)
+            else:
                 # Fallback: если raw недоступен, используем колонку как есть.
                 rec = str(row["recommendations"] or "").strip()
                 if rec:
@@ -180,35 +301,62 @@ class WineDB:
         raw_sql: str,
         max_rows: int = 200,
     ) -> tuple[str, list[dict]]:
-        safe_sql = build_safe_sql(raw_sql, max_rows=max_rows)
-        exec_sql = rewrite_like_to_ru_like(safe_sql)
-        with self._connect_ro() as conn:
-            cursor = conn.execute(exec_sql)
-            rows = cursor.fetchall()
-
-        result = [dict(row) for row in rows]
+        safe_sql, exec_sql = _prepare_safe_sql(raw_sql, max_rows)
+        # dict строится прямо из курсора, без промежуточного списка sqlite3.Row от fetchall().
+        with self._read_conn() as conn:
+            result = [dict(row) for row in conn.execute(exec_sql)]
         return safe_sql, result
 
+    def execute_safe_query_head(
+        self,
+        raw_sql: str,
+        max_rows: int = 200,
+        head_rows: int = 80,
+    ) -> tuple[str, list[dict], int]:
+        # Строки читаются курсором по одной: в dict превращаются только первые head_rows,
+        # остальные лишь подсчитываются.
+        safe_sql, exec_sql = _prepare_safe_sql(raw_sql, max_rows)
+        head: list[dict] = []
+        total = 0
+        with self._read_conn() as conn:
+            for row in conn.execute(exec_sql):
+                if total < head_rows:
+                    head.append(dict(row))
+                total += 1
+        return safe_sql, head, total
+
+    @contextlib.contextmanager
+    def stream_safe_query(
+        self,
+        raw_sql: str,
+        max_rows: int = 200,
+    ) -> Iterator[tuple[str, list[str], sqlite3.Cursor]]:
+        # Для выгрузок: строки отдаются прямо курсором, соединение занято до выхода из with.
+        safe_sql, exec_sql = _prepare_safe_sql(raw_sql, max_rows)
+        with self._read_conn() as conn:
+            cursor = conn.execute(exec_sql)
+            try:
+                columns = [item[0] for item in cursor.description or ()]
+                yield safe_sql, columns, cursor
+            finally:
+                cursor.close()
+
     def wine_exists(self, wine_id: str) -> bool:
         value = str(wine_id or "").strip()
         if not value:
             return False
-        with self._connect_ro() as conn:
-            row = conn.execute(
-                f"""
-                SELECT 1
-                FROM {self.table_name}
-                WHERE CAST(card_key AS TEXT) = ?
-                   OR url = ?
-                LIMIT 1
-                """,
-                (value, value),
-            ).fetchone()
-        return row is not None
+        # Идентификаторов в каталоге немного: точное множество card_key/url отвечает без SQL
+        # и для промахов, и для попаданий; перечитывается вместе с файлом каталога.
+        return value in self._cached_meta("wine_ids", self._read_wine_ids)
+
+    def _read_wine_ids(self) -> frozenset[str]:
+        with self._read_conn() as conn:
+            rows = conn.execute(f"SELECT CAST(card_key AS TEXT), url FROM {self.table_name}").fetchall()
+        return frozenset(value for row in rows for value in row if value is not None)
 
     @staticmethod
     def _tokenize_reference(value: str) -> list[str]:
-        return [t for t in re.findall(r"[0-9a-zа-яё]+", str(value or "").lower()) if len(t) >= 2]
+        return [t for t in _REFERENCE_TOKEN_RE.findall(str(value or "").casefold()) if len(t) >= 2]
 
     def search_wines_by_text(self, reference: str, limit: int = 10) -> list[dict]:
         ref = str(reference or "").strip()
@@ -219,53 +367,95 @@ class WineDB:
         if not tokens:
             tokens = [ref.lower()]
 
-        where_parts = []
-        params: list[str | int] = []
-        for tok in tokens[:8]:
-            where_parts.append(
-                """
-                RU_LIKE(
-                    COALESCE(wine_name, '') || ' ' ||
-                    COALESCE(producer, '') || ' ' ||
-                    COALESCE(title, '')
-                , ?
-                ) = 1
-                """
-            )
-            params.append(f"%{tok}%")
+        # Фильтр по подстроке — в Python по закэшированному индексу текста карточек,
+        # чтобы не склеивать и не прогонять через RU_LIKE все строки таблицы на каждый токен.
+        matchers = [_compile_like_regex(f"%{tok}%".casefold(), "\\").match for tok in tokens[:8]]
+        rowids = [
+            rowid
+            for rowid, text in self._cached_meta("search_index", self._read_search_index)
+            if all(match(text) for match in matchers)
+        ]
+        if not rowids:
+            return []
 
-        params.append(max(1, min(int(limit), 50)))
-        where_sql = " AND ".join(where_parts) if where_parts else "1=1"
         query = f"""
             SELECT
                 card_key, wine_name, producer, harvest_year, region, rating_year, rating_points, url
             FROM {self.table_name}
-            WHERE {where_sql}
+            WHERE rowid IN (SELECT value FROM json_each(?))
             ORDER BY rating_year DESC, rating_points DESC, harvest_year DESC
             LIMIT ?
         """
-        with self._connect_ro() as conn:
-            rows = conn.execute(query, params).fetchall()
+        with self._read_conn() as conn:
+            rows = conn.execute(query, (json.dumps(rowids), max(1, min(int(limit), 50)))).fetchall()
         return [dict(r) for r in rows]
 
+    def _read_search_index(self) -> tuple[tuple[int, str], ...]:
+        with self._read_conn() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT
+                    rowid,
+                    COALESCE(wine_name, '') || ' ' ||
+                    COALESCE(producer, '') || ' ' ||
+                    COALESCE(title, '')
+                FROM {self.table_name}
+                ORDER BY rowid
+                """
+            ).fetchall()
+        return tuple((row[0], str(row[1]).casefold()) for row in rows)
+
     def get_wine_brief(self, wine_id: str) -> dict | None:
         value = str(wine_id or "").strip()
         if not value:
             return None
-        with self._connect_ro() as conn:
-            row = conn.execute(
+        with self._read_conn() as conn:
+            row = conn.execute(self._sql_wine_brief, (value, value)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_wine_briefs_bulk(self, wine_ids: Iterable[str]) -> dict[str, dict]:
+        values = [v for v in dict.fromkeys(str(v or "").strip() for v in wine_ids) if v]
+        if not values:
+            return {}
+        placeholders = ",".join("?" * len(values))
+        with self._read_conn() as conn:
+            rows = conn.execute(
                 f"""
                 SELECT
+                    CAST(card_key AS TEXT) AS card_key_text,
                     card_key, wine_name, producer, harvest_year, region, rating_year, rating_points, url
                 FROM {self.table_name}
-                WHERE CAST(card_key AS TEXT) = ?
-                   OR url = ?
+                WHERE CAST(card_key AS TEXT) IN ({placeholders})
+                   OR url IN ({placeholders})
                 ORDER BY rating_year DESC, rating_points DESC, harvest_year DESC
-                LIMIT 1
                 """,
-                (value, value),
-            ).fetchone()
-        return dict(row) if row is not None else None
+                (*values, *values),
+            ).fetchall()
+        # Как и в get_wine_brief, для каждого id берется первая строка в порядке сортировки.
+        wanted = set(values)
+        result: dict[str, dict] = {}
+        for row in rows:
+            brief = dict(row)
+            key_text = brief.pop("card_key_text")
+            for key in (key_text, brief.get("url")):
+                if key in wanted and key not in result:
+                    result[key] = brief
+        return result
+
+    def _build_resolve_wine_id_sql(self, with_producer: bool, with_year: bool) -> str:
+        clauses = ["LOWER(COALESCE(wine_name,'')) = LOWER(?)"]
+        if with_producer:
+            clauses.append("LOWER(COALESCE(producer,'')) = LOWER(?)")
+        if with_year:
+            clauses.append("CAST(COALESCE(harvest_year,'') AS TEXT) = ?")
+        where_sql = " AND ".join(clauses)
+        return f"""
+            SELECT card_key
+            FROM {self.table_name}
+            WHERE {where_sql}
+            ORDER BY rating_year DESC, rating_points DESC
+            LIMIT 1
+        """
 
     def resolve_wine_id_from_fields(
         self,
@@ -279,24 +469,15 @@ class WineDB:
         prod = str(producer or "").strip()
         year = str(harvest_year or "").strip()
 
-        clauses = ["LOWER(COALESCE(wine_name,'')) = LOWER(?)"]
         params: list[str] = [name]
         if prod:
-            clauses.append("LOWER(COALESCE(producer,'')) = LOWER(?)")
             params.append(prod)
-        if year and year.isdigit():
-            clauses.append("CAST(COALESCE(harvest_year,'') AS TEXT) = ?")
+        with_year = bool(year and year.isdigit())
+        if with_year:
             params.append(year)
 
-        where_sql = " AND ".join(clauses)
-        query = f"""
-            SELECT card_key
-            FROM {self.table_name}
-            WHERE {where_sql}
-            ORDER BY rating_year DESC, rating_points DESC
-            LIMIT 1
-        """
-        with self._connect_ro() as conn:
+        query = self._sql_resolve_wine_id[(bool(prod), with_year)]
+        with self._read_conn() as conn:
             row = conn.execute(query, params).fetchone()
         if row is None:
             return None
@@ -0,0 +1,28 @@
+import json
+from typing import Any, Callable
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+ORJSON_AVAILABLE = orjson is not None
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def dumps_bytes(obj: Any, default: Callable[[Any], Any] | None = None) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, ensure_ascii=False, default=default).encode("utf-8")
+
+
+def dumps(obj: Any, default: Callable[[Any], Any] | None = None) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=_ORJSON_OPTIONS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, default=default)
+
+
+def loads(data: str | bytes | bytearray) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -1,20 +1,34 @@
+import atexit
 import os
+import queue
 import threading
+import time
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, TextIO
 
 _LOCK = threading.Lock()
 _BASE_DIR = Path(__file__).resolve().parent
 _DEFAULT_LOG_DIR = _BASE_DIR / "logs"
 _DEFAULT_LOG_PATH = _DEFAULT_LOG_DIR / "wine_chat_perf.log"
 
+_QUEUE_MAX_SIZE = 10_000
+_BATCH_MAX_SIZE = 128
+_BATCH_WAIT_SEC = 0.05
+_QUEUE: queue.Queue[tuple[Path, str, str, dict[str, Any]]] = queue.Queue(maxsize=_QUEUE_MAX_SIZE)
+_WRITER: threading.Thread | None = None
+_WRITER_PID: int | None = None
+_STOP = threading.Event()
+_HANDLES: dict[Path, TextIO] = {}
+_FILE_BUFFER_SIZE = 64 * 1024
+_TRUE_VALUES = frozenset({"1", "true", "yes", "on"})
+
 
 def _to_bool(value: str | None, default: bool = False) -> bool:
     raw = str(value or "").strip().lower()
     if not raw:
         return default
-    return raw in {"1", "true", "yes", "on"}
+    return raw in _TRUE_VALUES
 
 
 def is_perf_log_enabled() -> bool:
@@ -31,54 +45,152 @@ def get_perf_log_path() -> Path:
     return _DEFAULT_LOG_PATH
 
 
+def elapsed_ms(start_ns: int) -> float:
+    # start_ns берется из time.monotonic_ns(); результат — миллисекунды с точностью до сотых.
+    return (time.monotonic_ns() - start_ns) // 10_000 / 100
+
+
+_VALUE_FORMATTERS: dict[type, Callable[[Any], str]] = {
+    type(None): lambda value: "-",
+    bool: lambda value: "yes" if value else "no",
+    float: lambda value: f"{value:.2f}",
+}
+
+
 def _format_value(value: Any) -> str:
-    if value is None:
-        return "-"
-    if isinstance(value, bool):
-        return "yes" if value else "no"
-    if isinstance(value, float):
-        return f"{value:.2f}"
-    text = str(value).strip()
-    text = " ".join(text.split())
+    formatter = _VALUE_FORMATTERS.get(type(value))
+    if formatter is None:
+        # Подклассы (numpy.float64, IntEnum и т.п.) форматируются как базовый тип; bool раньше float.
+        for base in (bool, float):
+            if isinstance(value, base):
+                formatter = _VALUE_FORMATTERS.setdefault(type(value), _VALUE_FORMATTERS[base])
+                break
+    if formatter is not None:
+        return formatter(value)
+    # После split/join пробельные символы схлопнуты в одиночные пробелы.
+    text = " ".join(str(value).split())
     if not text:
         return "-"
-    if any(ch.isspace() for ch in text):
+    if " " in text:
         return f'"{text}"'
     return text
 
 
+_PRIORITY_FIELDS = (
+    "status",
+    "method",
+    "path",
+    "public_user",
+    "user_source",
+    "selected_model",
+    "request_ms",
+    "total_ms",
+    "llm_rounds",
+    "llm_wait_ms_total",
+    "db_tool_calls",
+    "db_query_ms_total",
+    "web_tool_calls",
+    "web_query_ms_total",
+    "fallback_web_calls",
+    "fallback_web_ms_total",
+    "rows",
+    "sql_count",
+    "web_count",
+    "sid",
+)
+_PRIORITY_FIELDS_SET = frozenset(_PRIORITY_FIELDS)
+
+
 def _format_human_line(ts: str, event: str, fields: dict[str, Any]) -> str:
-    priority = [
-        "status",
-        "method",
-        "path",
-        "public_user",
-        "user_source",
-        "selected_model",
-        "request_ms",
-        "total_ms",
-        "llm_rounds",
-        "llm_wait_ms_total",
-        "db_tool_calls",
-        "db_query_ms_total",
-        "web_tool_calls",
-        "web_query_ms_total",
-        "fallback_web_calls",
-        "fallback_web_ms_total",
-        "rows",
-        "sql_count",
-        "web_count",
-        "sid",
-    ]
-    parts: list[str] = [f"{ts}", f"event={event}"]
-    seen: set[str] = set()
-    for key in priority:
-        if key in fields:
-            parts.append(f"{key}={_format_value(fields[key])}")
-            seen.add(key)
-    for key in sorted(k for k in fields.keys() if k not in seen):
-        parts.append(f"{key}={_format_value(fields[key])}")
-    return " | ".join(parts)
+    keys = [key for key in _PRIORITY_FIELDS if key in fields]
+    keys.extend(sorted(key for key in fields if key not in _PRIORITY_FIELDS_SET))
+    body = "".join(f" | {key}={_format_value(fields[key])}" for key in keys)
+    return f"{ts} | event={event}{body}"
+
+
+def _write_batch(batch: list[tuple[Path, str, str, dict[str, Any]]]) -> None:
+    by_path: dict[Path, list[str]] = {}
+    for path, ts, event_name, fields in batch:
+        try:
+            line = _format_human_line(ts=ts, event=event_name, fields=fields) + "\n"
+        except Exception:
+            continue
+        by_path.setdefault(path, []).append(line)
+
+    for path, lines in by_path.items():
+        try:
+            with _LOCK:
+                f = _open_log(path)
+                f.write("".join(lines))
+                f.flush()
+        except Exception:
+            pass
+
+
+def _open_log(path: Path) -> TextIO:
+    # Файл лога держится открытым: на пачку событий — один write без open/close.
+    f = _HANDLES.get(path)
+    if f is None or f.closed:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        f = path.open("a", encoding="utf-8", buffering=_FILE_BUFFER_SIZE)
+        _HANDLES[path] = f
+    return f
+
+
+def _close_logs() -> None:
+    with _LOCK:
+        for f in _HANDLES.values():
+            try:
+                f.close()
+            except Exception:
+                pass
+        _HANDLES.clear()
+
+
+def _drain_batch(block: bool) -> list[tuple[Path, str, str, dict[str, Any]]]:
+    batch: list[tuple[Path, str, str, dict[str, Any]]] = []
+    try:
+        if block:
+            batch.append(_QUEUE.get(timeout=_BATCH_WAIT_SEC))
+        while len(batch) < _BATCH_MAX_SIZE:
+            batch.append(_QUEUE.get_nowait())
+    except queue.Empty:
+        pass
+    return batch
+
+
+def _writer_loop() -> None:
+    while not _STOP.is_set():
+        batch = _drain_batch(block=True)
+        if batch:
+            _write_batch(batch)
+            for _ in batch:
+                _QUEUE.task_done()
+
+
+def _ensure_writer() -> None:
+    global _WRITER, _WRITER_PID
+    pid = os.getpid()
+    # После fork поток-писатель родителя в дочернем процессе не существует.
+    if _WRITER is not None and _WRITER_PID == pid and _WRITER.is_alive():
+        return
+    with _LOCK:
+        if _WRITER is not None and _WRITER_PID == pid and _WRITER.is_alive():
+            return
+        _WRITER = threading.Thread(target=_writer_loop, name="perf-log-writer", daemon=True)
+        _WRITER_PID = pid
+        _WRITER.start()
+
+
+def flush_perf_log() -> None:
+    # Дописывает все накопленные записи в вызывающем потоке.
+    while True:
+        batch = _drain_batch(block=False)
+        if not batch:
+            return
+        _write_batch(batch)
+        for _ in batch:
+            _QUEUE.task_done()
 
 
 def append_perf_log(event: str, **fields: Any) -> bool:
@@ -91,18 +203,29 @@ def append_perf_log(event: str, **fields: Any) -> bool:
     for key, value in fields.items():
         normalized_fields[str(key)] = value
 
-    path = get_perf_log_path()
+    # Запись в файл выполняет фоновый поток; при переполнении очереди событие отбрасывается.
     try:
-        path.parent.mkdir(parents=True, exist_ok=True)
-        line = _format_human_line(ts=ts, event=event_name, fields=normalized_fields) + "\n"
-        with _LOCK:
-            with path.open("a", encoding="utf-8") as f:
-                f.write(line)
+        _ensure_writer()
+        _QUEUE.put_nowait((get_perf_log_path(), ts, event_name, normalized_fields))
         return True
+    except queue.Full:
+        return False
     except Exception:
         return False
 
 
+def _shutdown_writer() -> None:
+    _STOP.set()
+    writer = _WRITER
+    if writer is not None and writer.is_alive():
+        writer.join(timeout=1.0)
+    flush_perf_log()
+    _close_logs()
+
+
+atexit.register(_shutdown_writer)
+
+
 def tail_perf_log(lines: int = 100, max_bytes: int = 262_144) -> list[str]:
     path = get_perf_log_path()
     if not path.exists() or lines <= 0:
@@ -116,7 +239,15 @@ def tail_perf_log(lines: int = 100, max_bytes: int = 262_144) -> list[str]:
             read_size = min(file_size, max_bytes)
             f.seek(-read_size, os.SEEK_END)
             data = f.read(read_size)
-        text = data.decode("utf-8", errors="replace")
+        # Декодируется только хвост с последними limit_lines непустыми строками.
+        start = end = len(data)
+        found = 0
+        while found < limit_lines and end > 0:
+            start = data.rfind(b"\n", 0, end) + 1
+            if data[start:end].strip():
+                found += 1
+            end = start - 1
+        text = data[start:].decode("utf-8", errors="replace")
         result = [line for line in text.splitlines() if line.strip()]
         if len(result) > limit_lines:
             result = result[-limit_lines:]
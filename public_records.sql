@@ -8,8 +8,12 @@ CREATE TABLE IF NOT EXISTS public_records (
     updated_at TEXT NOT NULL DEFAULT (datetime('now'))
 );
 
-CREATE INDEX IF NOT EXISTS idx_public_records_wine_id
-    ON public_records (wine_id);
+-- Покрывает фильтры list_records/get_wine_summary по вину (и типу) вместе с сортировкой списка.
+CREATE INDEX IF NOT EXISTS idx_public_records_wine_type
+    ON public_records (wine_id, record_type, created_at DESC, id DESC);
+
+-- Префикс wine_id есть в idx_public_records_wine_type.
+DROP INDEX IF EXISTS idx_public_records_wine_id;
 
 CREATE INDEX IF NOT EXISTS idx_public_records_record_type
     ON public_records (record_type);
@@ -1,8 +1,48 @@
+import contextlib
 import sqlite3
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any
+from typing import Any, Container, Iterable, Iterator
 
-from db import WineDB
+from db import READ_PRAGMAS, ConnectionPool, WineDB
+
+SUMMARY_CACHE_SIZE = 2048
+
+WRITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def _build_list_records_sql(with_wine_id: bool, with_record_type: bool, with_user: bool) -> str:
+    clauses = [
+        clause
+        for clause, enabled in (
+            ("wine_id = ?", with_wine_id),
+            ("record_type = ?", with_record_type),
+            ("user = ?", with_user),
+        )
+        if enabled
+    ]
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return (
+        "SELECT * FROM public_records "
+        f"{where_sql} "
+        "ORDER BY created_at DESC, id DESC"
+    )
+
+
+# Все 8 вариантов фильтров list_records заранее: текст SQL стабилен и берется из кэша выражений sqlite3.
+_LIST_RECORDS_SQL = {
+    (w, t, u): _build_list_records_sql(w, t, u)
+    for w in (False, True)
+    for t in (False, True)
+    for u in (False, True)
+}
 
 
 class PublicRecordError(Exception):
@@ -10,25 +50,68 @@ class PublicRecordError(Exception):
 
 
 class PublicRecordsDB:
-    def __init__(self, db_path: str | Path, wine_db: WineDB):
+    def __init__(self, db_path: str | Path, wine_db: WineDB, pool_size: int = 4):
         self.db_path = Path(db_path).resolve()
         self.wine_db = wine_db
         self._ensure_parent_dir()
+        # Один писатель под блокировкой + пул читателей (WAL не блокирует чтение).
+        self._write_lock = threading.Lock()
+        self._writer = self._connect_rw()
         self._ensure_schema()
+        self._pool = ConnectionPool(self._connect_ro, size=pool_size)
+        # Счетчики по вину: свои вставки сбрасывают запись сразу, чужие (другие процессы)
+        # видны по PRAGMA data_version соединения-писателя.
+        self._summary_lock = threading.Lock()
+        self._summary_cache: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._summary_version: int | None = None
+        self._summary_generation = 0
 
     def _ensure_parent_dir(self) -> None:
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
 
     def _connect_rw(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path)
+        # Транзакции писателя открываются явно в _write_conn.
+        conn = sqlite3.connect(self.db_path, timeout=5.0, check_same_thread=False, isolation_level=None)
         conn.row_factory = sqlite3.Row
+        for pragma in WRITE_PRAGMAS:
+            conn.execute(pragma)
         return conn
 
+    def _connect_ro(self) -> sqlite3.Connection:
+        uri = f"file:{self.db_path.as_posix()}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=5.0, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in READ_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextlib.contextmanager
+    def _write_conn(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE сразу берет блокировку записи: без позднего апгрейда блокировки внутри транзакции.
+        with self._write_lock:
+            conn = self._writer
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _read_conn(self) -> contextlib.AbstractContextManager[sqlite3.Connection]:
+        return self._pool.connection()
+
+    def close(self) -> None:
+        self._pool.close()
+        with self._write_lock:
+            self._writer.close()
+
     def _ensure_schema(self) -> None:
         schema_path = Path(__file__).resolve().parent / "public_records.sql"
         schema_sql = schema_path.read_text(encoding="utf-8")
-        with self._connect_rw() as conn:
-            conn.executescript(schema_sql)
+        # executescript сам управляет транзакцией, поэтому идет мимо _write_conn.
+        with self._write_lock:
+            self._writer.executescript(schema_sql)
 
     @staticmethod
     def _normalize_record_type(value: str) -> str:
@@ -48,14 +131,30 @@ class PublicRecordsDB:
     def _normalize_content(value: str | None) -> str:
         return str(value or "").strip()
 
-    def _normalize_wine_id(self, value: str) -> str:
+    def _normalize_wine_id(self, value: str, known_ids: Container[str] | None = None) -> str:
         wine_id = str(value or "").strip()
         if not wine_id:
             raise PublicRecordError("wine_id обязателен.")
-        if not self.wine_db.wine_exists(wine_id):
+        exists = wine_id in known_ids if known_ids is not None else self.wine_db.wine_exists(wine_id)
+        if not exists:
             raise PublicRecordError("wine_id не найден в каталоге wine_cards_wide.")
         return wine_id
 
+    def _normalize_record_fields(
+        self,
+        user: str | None,
+        record_type: str,
+        content: str | None,
+    ) -> tuple[str, str, str]:
+        normalized_user = self._normalize_user(user)
+        normalized_type = self._normalize_record_type(record_type)
+        normalized_content = self._normalize_content(content)
+        if normalized_type == "note" and not normalized_content:
+            raise PublicRecordError("Для record_type='note' поле content обязательно.")
+        if normalized_type == "like":
+            normalized_content = normalized_content or "1"
+        return normalized_user, normalized_type, normalized_content
+
     @staticmethod
     def _row_to_dict(row: sqlite3.Row | None) -> dict[str, Any] | None:
         if row is None:
@@ -63,7 +162,7 @@ class PublicRecordsDB:
         return {k: row[k] for k in row.keys()}
 
     def ping(self) -> bool:
-        with self._connect_rw() as conn:
+        with self._read_conn() as conn:
             conn.execute("SELECT 1").fetchone()
         return True
 
@@ -74,33 +173,64 @@ class PublicRecordsDB:
         content: str | None,
         wine_id: str,
     ) -> dict[str, Any]:
-        normalized_user = self._normalize_user(user)
-        normalized_type = self._normalize_record_type(record_type)
-        normalized_content = self._normalize_content(content)
-        normalized_wine_id = self._normalize_wine_id(wine_id)
+        return self.add_records([(user, record_type, content, wine_id)])[0]
 
-        if normalized_type == "note" and not normalized_content:
-            raise PublicRecordError("Для record_type='note' поле content обязательно.")
-        if normalized_type == "like":
-            normalized_content = normalized_content or "1"
+    def add_records(
+        self,
+        records: list[tuple[str | None, str, str | None, str]],
+    ) -> list[dict[str, Any]]:
+        # Все записи проверяются до записи и вставляются одной транзакцией: при ошибке не пишется ничего.
+        rows = [
+            (*self._normalize_record_fields(user, record_type, content), self._normalize_wine_id(wine_id))
+            for user, record_type, content, wine_id in records
+        ]
+        return self._insert_rows(rows)
 
-        with self._connect_rw() as conn:
-            cur = conn.execute(
+    def add_records_bulk(
+        self,
+        user: str | None,
+        record_type: str,
+        content: str | None,
+        wine_ids: list[str],
+    ) -> tuple[list[dict[str, Any]], list[tuple[str, PublicRecordError]]]:
+        # Одна проверка каталога и одна транзакция на все вина; ошибки возвращаются по каждому wine_id.
+        normalized_user, normalized_type, normalized_content = self._normalize_record_fields(
+            user, record_type, content
+        )
+        known_ids = self.wine_db.get_wine_briefs_bulk(wine_ids)
+        valid_ids: list[str] = []
+        errors: list[tuple[str, PublicRecordError]] = []
+        for wine_id in wine_ids:
+            try:
+                valid_ids.append(self._normalize_wine_id(wine_id, known_ids))
+            except PublicRecordError as exc:
+                errors.append((wine_id, exc))
+        if not valid_ids:
+            return [], errors
+        rows = [(normalized_user, normalized_type, normalized_content, wine_id) for wine_id in valid_ids]
+        return self._insert_rows(rows), errors
+
+    def _insert_rows(self, rows: list[tuple[str, str, str, str]]) -> list[dict[str, Any]]:
+        if not rows:
+            return []
+        with self._write_conn() as conn:
+            conn.executemany(
                 """
                 INSERT INTO public_records (user, record_type, content, wine_id)
                 VALUES (?, ?, ?, ?)
                 """,
-                (normalized_user, normalized_type, normalized_content, normalized_wine_id),
+                rows,
             )
-            rec_id = int(cur.lastrowid)
-            row = conn.execute(
-                "SELECT * FROM public_records WHERE id = ?",
-                (rec_id,),
-            ).fetchone()
-        result = self._row_to_dict(row)
-        if not result:
+            # Писатель один и держит блокировку записи: id вставленных строк идут подряд.
+            last_id = int(conn.execute("SELECT last_insert_rowid()").fetchone()[0])
+            inserted = conn.execute(
+                "SELECT * FROM public_records WHERE id BETWEEN ? AND ? ORDER BY id",
+                (last_id - len(rows) + 1, last_id),
+            ).fetchall()
+        self._invalidate_summaries(row[3] for row in rows)
+        if len(inserted) != len(rows):
             raise PublicRecordError("Не удалось прочитать созданную запись.")
-        return result
+        return [self._row_to_dict(row) for row in inserted]
 
     def list_records(
         self,
@@ -108,52 +238,86 @@ class PublicRecordsDB:
         record_type: str | None = None,
         user: str | None = None,
     ) -> list[dict[str, Any]]:
-        clauses: list[str] = []
-        params: list[Any] = []
-
-        if wine_id is not None and str(wine_id).strip():
-            clauses.append("wine_id = ?")
-            params.append(str(wine_id).strip())
-
-        if record_type is not None and str(record_type).strip():
-            clauses.append("record_type = ?")
-            params.append(self._normalize_record_type(record_type))
-
-        if user is not None and str(user).strip():
-            clauses.append("user = ?")
-            params.append(str(user).strip())
-
-        where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
-        sql = (
-            "SELECT * FROM public_records "
-            f"{where_sql} "
-            "ORDER BY created_at DESC, id DESC"
-        )
-        with self._connect_rw() as conn:
-            rows = conn.execute(sql, params).fetchall()
-        return [{k: row[k] for k in row.keys()} for row in rows]
+        return list(self.iter_records(wine_id=wine_id, record_type=record_type, user=user))
+
+    def iter_records(
+        self,
+        wine_id: str | None = None,
+        record_type: str | None = None,
+        user: str | None = None,
+        batch_size: int = 256,
+    ) -> Iterator[dict[str, Any]]:
+        # Записи читаются пачками через fetchmany, а не одним fetchall: в памяти не держится
+        # весь результат. Соединение из пула занято, пока генератор не исчерпан или не закрыт.
+        wine_value = str(wine_id).strip() if wine_id is not None else ""
+        type_value = str(record_type).strip() if record_type is not None else ""
+        if type_value:
+            type_value = self._normalize_record_type(type_value)
+        user_value = str(user).strip() if user is not None else ""
+
+        params = tuple(value for value in (wine_value, type_value, user_value) if value)
+        sql = _LIST_RECORDS_SQL[(bool(wine_value), bool(type_value), bool(user_value))]
+        with self._read_conn() as conn:
+            cursor = conn.cursor()
+            # Кортежи вместо sqlite3.Row: dict собирается напрямую из имен колонок.
+            cursor.row_factory = None
+            try:
+                cursor.execute(sql, params)
+                columns = [item[0] for item in cursor.description]
+                while rows := cursor.fetchmany(batch_size):
+                    for row in rows:
+                        yield dict(zip(columns, row))
+            finally:
+                cursor.close()
+
+    def _invalidate_summaries(self, wine_ids: Iterable[str]) -> None:
+        with self._summary_lock:
+            self._summary_generation += 1
+            for wine_id in wine_ids:
+                self._summary_cache.pop(wine_id, None)
+
+    def _external_data_version(self) -> int:
+        with self._write_lock:
+            return int(self._writer.execute("PRAGMA data_version").fetchone()[0])
 
     def get_wine_summary(self, wine_id: str) -> dict[str, Any]:
         normalized_wine_id = self._normalize_wine_id(wine_id)
-        with self._connect_rw() as conn:
-            likes_row = conn.execute(
-                """
-                SELECT COUNT(*) AS like_count
-                FROM public_records
-                WHERE wine_id = ? AND record_type = 'like'
-                """,
-                (normalized_wine_id,),
-            ).fetchone()
-            notes_row = conn.execute(
+        version = self._external_data_version()
+        with self._summary_lock:
+            if version != self._summary_version:
+                self._summary_cache.clear()
+                self._summary_version = version
+            cached = self._summary_cache.get(normalized_wine_id)
+            if cached is not None:
+                self._summary_cache.move_to_end(normalized_wine_id)
+                return dict(cached)
+            generation = self._summary_generation
+
+        summary = self._read_wine_summary(normalized_wine_id)
+        with self._summary_lock:
+            # Если за время чтения были свои вставки, результат мог устареть: не кэшируем.
+            if generation == self._summary_generation and version == self._summary_version:
+                self._summary_cache[normalized_wine_id] = summary
+                if len(self._summary_cache) > SUMMARY_CACHE_SIZE:
+                    self._summary_cache.popitem(last=False)
+        return dict(summary)
+
+    def _read_wine_summary(self, normalized_wine_id: str) -> dict[str, Any]:
+        counts = {"like": 0, "note": 0}
+        with self._read_conn() as conn:
+            rows = conn.execute(
                 """
-                SELECT COUNT(*) AS note_count
+                SELECT record_type, COUNT(*) AS cnt
                 FROM public_records
-                WHERE wine_id = ? AND record_type = 'note'
+                WHERE wine_id = ? AND record_type IN ('like', 'note')
+                GROUP BY record_type
                 """,
                 (normalized_wine_id,),
-            ).fetchone()
+            ).fetchall()
+        for row in rows:
+            counts[row["record_type"]] = int(row["cnt"])
         return {
             "wine_id": normalized_wine_id,
-            "like_count": int(likes_row["like_count"]) if likes_row else 0,
-            "note_count": int(notes_row["note_count"]) if notes_row else 0,
+            "like_count": counts["like"],
+            "note_count": counts["note"],
         }
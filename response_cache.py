@@ -0,0 +1,65 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+def make_cache_key(*parts: Any) -> str:
+    # Ключ — короткий хэш, чтобы длинная история не хранилась в памяти целиком.
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            for item in part:
+                digest.update(str(item).encode("utf-8"))
+                digest.update(b"\x1f")
+        else:
+            digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = 1024, ttl_sec: float = 3600.0):
+        self.max_size = max(0, int(max_size))
+        self.ttl_sec = float(ttl_sec)
+        self._items: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl_sec > 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: str) -> Any:
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if now > expires_at:
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl_sec: float | None = None) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + (self.ttl_sec if ttl_sec is None else float(ttl_sec))
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+            elif len(self._items) >= self.max_size:
+                self._items.popitem(last=False)
+            self._items[key] = (expires_at, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
@@ -0,0 +1,157 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import fast_json
+
+
+class ChatMessage(NamedTuple):
+    role: str
+    content: str
+
+    def to_dict(self) -> dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+class SessionStore:
+    def __init__(
+        self,
+        db_path: str | Path,
+        max_history_items: int = 24,
+        ttl_sec: float = 7200.0,
+        purge_interval_sec: float = 600.0,
+    ):
+        self.db_path = Path(db_path).resolve()
+        self.max_history_items = max(1, int(max_history_items))
+        self.ttl_sec = float(ttl_sec)
+        self.purge_interval_sec = float(purge_interval_sec)
+        self._last_purge = time.monotonic()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._ensure_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _ensure_schema(self) -> None:
+        schema_path = Path(__file__).resolve().parent / "sessions.sql"
+        schema_sql = schema_path.read_text(encoding="utf-8")
+        with self._lock:
+            self._conn.executescript(schema_sql)
+
+    def ping(self) -> bool:
+        with self._lock:
+            self._conn.execute("SELECT 1").fetchone()
+        return True
+
+    def get_history(self, sid: str) -> list[ChatMessage]:
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT role, content
+                FROM chat_messages
+                WHERE sid = ?
+                ORDER BY id DESC
+                LIMIT ?
+                """,
+                (sid, self.max_history_items),
+            ).fetchall()
+        return [ChatMessage(row["role"], row["content"]) for row in reversed(rows)]
+
+    def append_messages(self, sid: str, messages: list[tuple[str, str]]) -> None:
+        if not messages:
+            return
+        # Все вставки и обрезка истории выполняются одной транзакцией.
+        with self._lock, self._conn:
+            self._touch_locked(sid)
+            self._conn.executemany(
+                "INSERT INTO chat_messages (sid, role, content) VALUES (?, ?, ?)",
+                [(sid, role, content) for role, content in messages],
+            )
+            self._conn.execute(
+                """
+                DELETE FROM chat_messages
+                WHERE sid = ?
+                  AND id NOT IN (
+                      SELECT id FROM chat_messages
+                      WHERE sid = ?
+                      ORDER BY id DESC
+                      LIMIT ?
+                  )
+                """,
+                (sid, sid, self.max_history_items),
+            )
+
+    def get_context(self, sid: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state_json FROM session_context WHERE sid = ?",
+                (sid,),
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            state = fast_json.loads(row["state_json"])
+        except (TypeError, ValueError):
+            return None
+        return state if isinstance(state, dict) else None
+
+    def save_context(self, sid: str, state: dict[str, Any]) -> None:
+        state_json = fast_json.dumps(state, default=str)
+        with self._lock, self._conn:
+            self._touch_locked(sid)
+            self._conn.execute(
+                """
+                INSERT INTO session_context (sid, state_json, updated_at)
+                VALUES (?, ?, datetime('now'))
+                ON CONFLICT(sid) DO UPDATE SET
+                    state_json = excluded.state_json,
+                    updated_at = excluded.updated_at
+                """,
+                (sid, state_json),
+            )
+
+    def _touch_locked(self, sid: str) -> None:
+        self._conn.execute(
+            """
+            INSERT INTO chat_sessions (sid, last_seen)
+            VALUES (?, datetime('now'))
+            ON CONFLICT(sid) DO UPDATE SET last_seen = excluded.last_seen
+            """,
+            (sid,),
+        )
+        self._maybe_purge_locked()
+
+    def _maybe_purge_locked(self) -> None:
+        # Чистка идет попутно с записью, не чаще purge_interval_sec.
+        now = time.monotonic()
+        if self.ttl_sec <= 0 or now - self._last_purge < self.purge_interval_sec:
+            return
+        self._last_purge = now
+        self._purge_locked()
+
+    def purge_expired(self) -> int:
+        if self.ttl_sec <= 0:
+            return 0
+        with self._lock, self._conn:
+            return self._purge_locked()
+
+    def _purge_locked(self) -> int:
+        # Удаляет историю и контекст сессий без записей дольше ttl_sec (тот же TTL, что у кэша в памяти).
+        cutoff = self._conn.execute(
+            "SELECT datetime('now', ?)",
+            (f"-{int(self.ttl_sec)} seconds",),
+        ).fetchone()[0]
+        expired = "SELECT sid FROM chat_sessions WHERE last_seen < ?"
+        self._conn.execute(f"DELETE FROM chat_messages WHERE sid IN ({expired})", (cutoff,))
+        self._conn.execute(f"DELETE FROM session_context WHERE sid IN ({expired})", (cutoff,))
+        return self._conn.execute("DELETE FROM chat_sessions WHERE last_seen < ?", (cutoff,)).rowcount
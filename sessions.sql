@@ -0,0 +1,32 @@
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sid TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_messages_sid_id
+    ON chat_messages (sid, id);
+
+CREATE TABLE IF NOT EXISTS session_context (
+    sid TEXT PRIMARY KEY,
+    state_json TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+-- Последняя запись по сессии: по ней удаляются истекшие сессии (см. SessionStore.purge_expired).
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    sid TEXT PRIMARY KEY,
+    last_seen TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_sessions_last_seen
+    ON chat_sessions (last_seen);
+
+-- Сессии, созданные до появления chat_sessions, тоже попадают под истечение.
+INSERT OR IGNORE INTO chat_sessions (sid, last_seen)
+SELECT sid, MAX(created_at) FROM chat_messages GROUP BY sid;
+
+INSERT OR IGNORE INTO chat_sessions (sid, last_seen)
+SELECT sid, updated_at FROM session_context;
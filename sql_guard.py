@@ -22,33 +22,58 @@ FORBIDDEN_KEYWORDS = (
     "truncate",
 )
 
-
-def _strip_comments(sql: str) -> str:
-    sql = re.sub(r"/\*.*?\*/", "", sql, flags=re.S)
-    sql = re.sub(r"--[^\n]*", "", sql)
-    return sql
-
-
-def _normalize_sql(sql: str) -> str:
-    sql = _strip_comments(sql).strip()
+# Лексемы SQL за один проход: комментарии вырезаются, а строковые литералы и quoted-идентификаторы
+# не участвуют в поиске ключевых слов и ';' (например, WHERE name = 'Replace' или 'a--b').
+_SQL_LEXEME_RE = re.compile(
+    r"""
+    (?P<string>'(?:[^']|'')*')
+    | (?P<ident>"(?:[^"]|"")*" | `[^`]*` | \[[^\]]*\])
+    | (?P<comment>/\*.*?\*/ | --[^\n]*)
+    | (?P<code>[^'"`\[/-]+ | .)
+    """,
+    flags=re.S | re.X,
+)
+_LEXEME_PLACEHOLDERS = {"string": "''", "ident": '""'}
+_FORBIDDEN_RE = re.compile(
+    r"\b(?:" + "|".join(f"(?P<{keyword}>{keyword})" for keyword in FORBIDDEN_KEYWORDS) + r")\b",
+    flags=re.IGNORECASE,
+)
+_READ_PREFIX_RE = re.compile(r"(?:select|with) ", flags=re.IGNORECASE)
+
+
+def _normalize_sql(sql: str) -> tuple[str, str]:
+    # Возвращает запрос без комментариев и его "кодовую" часть, где литералы заменены пустыми.
+    parts: list[str] = []
+    code_parts: list[str] = []
+    for match in _SQL_LEXEME_RE.finditer(sql):
+        kind = match.lastgroup
+        if kind == "comment":
+            continue
+        parts.append(match.group())
+        code_parts.append(match.group() if kind == "code" else _LEXEME_PLACEHOLDERS[kind])
+    sql = "".join(parts).strip()
     if not sql:
         raise SQLValidationError("Пустой SQL-запрос.")
     sql = sql.rstrip(";").strip()
-    if ";" in sql:
+    code = "".join(code_parts).strip().rstrip(";").strip()
+    if ";" in code:
         raise SQLValidationError("Разрешен только один SQL-запрос.")
-    return sql
+    return sql, code
 
 
 def validate_read_only_sql(sql: str) -> str:
-    normalized = _normalize_sql(sql)
-    lower = normalized.lower()
+    normalized, code = _normalize_sql(sql)
 
-    if not (lower.startswith("select ") or lower.startswith("with ")):
+    # Регистр учитывают сами шаблоны: копия запроса в нижнем регистре не нужна.
+    if not _READ_PREFIX_RE.match(code):
         raise SQLValidationError("Разрешены только SELECT/CTE-запросы.")
 
-    for keyword in FORBIDDEN_KEYWORDS:
-        if re.search(rf"\b{keyword}\b", lower):
-            raise SQLValidationError(f"Запрещенное ключевое слово в SQL: {keyword}")
+    match = _FORBIDDEN_RE.search(code)
+    if match:
+        # В сообщении — первое по списку FORBIDDEN_KEYWORDS слово, как и при поиске по одному.
+        found = {m.lastgroup for m in _FORBIDDEN_RE.finditer(code, match.start())}
+        keyword = next(k for k in FORBIDDEN_KEYWORDS if k in found)
+        raise SQLValidationError(f"Запрещенное ключевое слово в SQL: {keyword}")
 
     return normalized
 
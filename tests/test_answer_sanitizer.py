@@ -0,0 +1,47 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from assistant import WineAssistant, _AnswerSanitizer  # noqa: E402
+
+FALLBACK = "Готов ответить по данным базы российских вин. Сформулируйте запрос."
+
+# Ожидаемые значения получены исходной очисткой всего текста (до построчного _AnswerSanitizer).
+BASELINE_CASES = [
+    ("web search\n www.https://x.com/a", "www."),
+    (".сайт.рфfoo-bar.orghttp://", ".сайт.рфfoo-bar.orghttp://"),
+    ("Текст.www.HTTP:///x.com", "Текст.www."),
+    ("/Ссылка\nruru-x.com-www.ruhttp://\n\n\n\r", "/\n-"),
+    ("-\rhttps://x.com\nдальше", "-\nдальше"),
+    (
+        "Вино Абрау\n\n\n\nСсылка: https://a.ru/x\nИсточники: wine.ru\nЦена   1000 руб.",
+        "Вино Абрау\n\n:\nЦена 1000 руб.",
+    ),
+    ("см. www.wine.ru и simplewine.ru/catalog", "см. и"),
+    ("", FALLBACK),
+]
+
+
+def _sanitize_streamed(text: str, chunk_size: int) -> str:
+    sanitizer = _AnswerSanitizer()
+    parts = [sanitizer.feed(text[i : i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    return "".join(parts) + sanitizer.finish() or FALLBACK
+
+
+class AnswerSanitizerTest(unittest.TestCase):
+    def test_matches_baseline_whole_text(self):
+        for text, expected in BASELINE_CASES:
+            with self.subTest(text=text):
+                self.assertEqual(WineAssistant._sanitize_public_answer(text), expected)
+
+    def test_streamed_chunks_match_baseline(self):
+        for text, expected in BASELINE_CASES:
+            for chunk_size in (1, 2, 3, 7):
+                with self.subTest(text=text, chunk_size=chunk_size):
+                    self.assertEqual(_sanitize_streamed(text, chunk_size), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sql_guard import SQLValidationError, build_safe_sql, validate_read_only_sql  # noqa: E402
+
+ONE_STATEMENT = "Разрешен только один SQL-запрос."
+READ_ONLY = "Разрешены только SELECT/CTE-запросы."
+
+
+class AcceptedSQLTest(unittest.TestCase):
+    def test_literals_and_quoted_identifiers_are_not_scanned(self):
+        # Ключевые слова, '--' и ';' внутри литералов и quoted-идентификаторов не мешают запросу;
+        # возвращается исходный текст вместе с литералами.
+        for sql in (
+            "SELECT * FROM t WHERE name = 'Replace'",
+            "SELECT 'a--b' AS x",
+            "SELECT 'x;y'",
+            "SELECT 'it''s; drop' FROM t",
+            'SELECT "drop" FROM t',
+            'SELECT "a"";drop" FROM t',
+            "SELECT [a--b] FROM t",
+            "SELECT `drop` FROM t",
+        ):
+            with self.subTest(sql=sql):
+                self.assertEqual(validate_read_only_sql(sql), sql)
+
+    def test_prefix_is_case_insensitive(self):
+        for sql in (
+            "select 1",
+            "SELECT 1",
+            "SeLeCt 1",
+            "with a as (select 1) select * from a",
+            "WITH a AS (SELECT 1) SELECT * FROM a",
+        ):
+            with self.subTest(sql=sql):
+                self.assertEqual(validate_read_only_sql(sql), sql)
+
+    def test_comments_and_trailing_semicolon_are_stripped(self):
+        self.assertEqual(validate_read_only_sql("SELECT 1;"), "SELECT 1")
+        self.assertEqual(validate_read_only_sql("SELECT 1 -- drop\n"), "SELECT 1")
+        self.assertEqual(validate_read_only_sql("SELECT /* delete */ 1"), "SELECT  1")
+
+    def test_keyword_as_part_of_identifier(self):
+        sql = "SELECT * FROM t WHERE updated_at > 0"
+        self.assertEqual(validate_read_only_sql(sql), sql)
+
+    def test_build_safe_sql_wraps_with_limit(self):
+        self.assertEqual(
+            build_safe_sql("SELECT 'x;y'", 5),
+            "SELECT * FROM (SELECT 'x;y') AS _result LIMIT 5",
+        )
+
+
+class RejectedSQLTest(unittest.TestCase):
+    def assertRejected(self, sql: str, message: str) -> None:
+        with self.assertRaises(SQLValidationError) as ctx:
+            validate_read_only_sql(sql)
+        self.assertEqual(str(ctx.exception), message)
+
+    def test_second_statement(self):
+        self.assertRejected("SELECT 1; DROP TABLE t", ONE_STATEMENT)
+
+    def test_semicolon_hidden_by_comments(self):
+        self.assertRejected("SELECT 1 /**/; DROP TABLE t", ONE_STATEMENT)
+        self.assertRejected("SELECT 1/**/;/**/SELECT 2", ONE_STATEMENT)
+
+    def test_unterminated_literal_is_scanned_as_code(self):
+        # Незакрытая кавычка не превращает хвост запроса в литерал.
+        self.assertRejected("SELECT 'abc drop", "Запрещенное ключевое слово в SQL: drop")
+        self.assertRejected("SELECT 'abc; DROP TABLE t", ONE_STATEMENT)
+        self.assertRejected('SELECT "abc drop', "Запрещенное ключевое слово в SQL: drop")
+
+    def test_non_select_prefix(self):
+        for sql in (
+            "delete from t",
+            "DELETE FROM t",
+            "insert into t values (1)",
+            "INSERT INTO t VALUES (1)",
+            "PRAGMA table_info(t)",
+            "EXPLAIN SELECT 1",
+            "'x' SELECT 1",
+        ):
+            with self.subTest(sql=sql):
+                self.assertRejected(sql, READ_ONLY)
+
+    def test_empty(self):
+        for sql in ("", "   ", "-- only comment", "/* x */"):
+            with self.subTest(sql=sql):
+                self.assertRejected(sql, "Пустой SQL-запрос.")
+
+    def test_forbidden_keyword_outside_literals(self):
+        self.assertRejected(
+            "SELECT * FROM t WHERE x = 'a' OR DELETE",
+            "Запрещенное ключевое слово в SQL: delete",
+        )
+
+    def test_keyword_precedence_follows_forbidden_keywords_order(self):
+        # При нескольких запрещенных словах в сообщении — первое по FORBIDDEN_KEYWORDS,
+        # а не первое по тексту запроса.
+        self.assertRejected("SELECT drop, insert FROM t", "Запрещенное ключевое слово в SQL: insert")
+        self.assertRejected(
+            "SELECT pragma, replace, update FROM t",
+            "Запрещенное ключевое слово в SQL: update",
+        )
+        self.assertRejected("SELECT truncate, ALTER FROM t", "Запрещенное ключевое слово в SQL: alter")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import functools
+import heapq
 import os
 import re
-from typing import Any
+from operator import itemgetter
+from typing import Any, Sequence
 
 from dotenv import find_dotenv, load_dotenv
 
@@ -43,22 +46,30 @@ NON_WINE_MARKERS = (
     "wordreference",
 )
 
+_URL_RE = re.compile(r"https?://[^\s\])>]+")
+_TOKEN_RE = re.compile(r"[0-9a-zа-яё]+")
+
 
 def _safe_text(value: Any) -> str:
     return " ".join(str(value or "").split()).strip()
 
 
+_PRIMITIVE_TYPES = frozenset({dict, list, str, int, float, bool, type(None)})
+# Методы сериализации, найденные у класса ответа: hasattr проверяется один раз на тип.
+_DUMP_METHODS: dict[type, tuple[str, ...]] = {}
+
+
 def _to_dict(value: Any) -> Any:
-    if isinstance(value, (dict, list, str, int, float, bool)) or value is None:
+    value_type = type(value)
+    if value_type in _PRIMITIVE_TYPES or isinstance(value, (dict, list, str, int, float, bool)):
         return value
-    if hasattr(value, "model_dump"):
-        try:
-            return value.model_dump()
-        except Exception:
-            pass
-    if hasattr(value, "to_dict"):
+    methods = _DUMP_METHODS.get(value_type)
+    if methods is None:
+        methods = tuple(name for name in ("model_dump", "to_dict") if hasattr(value_type, name))
+        _DUMP_METHODS[value_type] = methods
+    for name in methods:
         try:
-            return value.to_dict()
+            return getattr(value, name)()
         except Exception:
             pass
     data = getattr(value, "__dict__", None)
@@ -67,50 +78,31 @@ def _to_dict(value: Any) -> Any:
     return str(value)
 
 
-def _extract_message_text(resp_obj: Any, resp_dict: dict[str, Any]) -> str:
-    text = _safe_text(getattr(resp_obj, "output_text", ""))
-    if text:
-        return text
-
-    output = resp_dict.get("output") or []
-    for item in output:
-        if not isinstance(item, dict):
-            continue
-        if item.get("type") != "message":
-            continue
-        parts = item.get("content") or []
-        chunk_texts: list[str] = []
-        for part in parts:
-            if not isinstance(part, dict):
-                continue
-            ptype = part.get("type")
-            if ptype in {"output_text", "text"}:
-                chunk_texts.append(_safe_text(part.get("text")))
-        text = _safe_text(" ".join(chunk_texts))
-        if text:
-            return text
-    return ""
-
-
-def _extract_search_query(resp_dict: dict[str, Any], fallback: str) -> str:
-    output = resp_dict.get("output") or []
-    for item in output:
-        if not isinstance(item, dict):
-            continue
-        if item.get("type") != "web_search_call":
-            continue
-        action = item.get("action") or {}
-        if isinstance(action, dict):
-            query = _safe_text(action.get("query"))
+def _response_to_dict(response: Any) -> dict[str, Any]:
+    # Для разбора нужен только output: у pydantic-ответа сериализуется лишь он,
+    # без usage, tools, reasoning и прочих полей; _to_dict остается для других типов.
+    if callable(getattr(type(response), "model_dump", None)):
+        try:
+            data = response.model_dump(include={"output"})
+        except Exception:
+            data = None
+        if isinstance(data, dict):
+            return data
+    data = _to_dict(response)
+    return data if isinstance(data, dict) else {}
+
+
+def _first_action_query(action: dict[str, Any]) -> str:
+    query = _safe_text(action.get("query"))
+    if query:
+        return query
+    queries = action.get("queries") or []
+    if isinstance(queries, list):
+        for q in queries:
+            query = _safe_text(q)
             if query:
                 return query
-            queries = action.get("queries") or []
-            if isinstance(queries, list):
-                for q in queries:
-                    query = _safe_text(q)
-                    if query:
-                        return query
-    return fallback
+    return ""
 
 
 def _parse_source_item(src: dict[str, Any]) -> dict[str, str] | None:
@@ -127,7 +119,43 @@ def _parse_source_item(src: dict[str, Any]) -> dict[str, str] | None:
     return {"title": title, "url": url, "snippet": snippet}
 
 
-def _extract_sources(resp_dict: dict[str, Any]) -> list[dict[str, str]]:
+def _extract_response_parts(
+    resp_obj: Any,
+    resp_dict: dict[str, Any],
+    fallback_query: str,
+) -> tuple[str, str, list[dict[str, str]]]:
+    # Один проход по output: текст ответа, поисковый запрос и источники.
+    answer_text = _safe_text(getattr(resp_obj, "output_text", ""))
+    search_query = ""
+    call_sources: list[dict[str, Any]] = []
+    annotations: list[dict[str, Any]] = []
+
+    for item in resp_dict.get("output") or []:
+        if not isinstance(item, dict):
+            continue
+        item_type = item.get("type")
+        if item_type == "web_search_call":
+            action = item.get("action") or {}
+            if not isinstance(action, dict):
+                continue
+            if not search_query:
+                search_query = _first_action_query(action)
+            sources = action.get("sources") or []
+            if isinstance(sources, list):
+                call_sources.extend(src for src in sources if isinstance(src, dict))
+        elif item_type == "message":
+            chunk_texts: list[str] = []
+            for part in item.get("content") or []:
+                if not isinstance(part, dict):
+                    continue
+                if not answer_text and part.get("type") in {"output_text", "text"}:
+                    chunk_texts.append(_safe_text(part.get("text")))
+                part_annotations = part.get("annotations") or []
+                if isinstance(part_annotations, list):
+                    annotations.extend(ann for ann in part_annotations if isinstance(ann, dict))
+            if not answer_text:
+                answer_text = _safe_text(" ".join(chunk_texts))
+
     collected: list[dict[str, str]] = []
     seen: set[str] = set()
 
@@ -141,40 +169,11 @@ def _extract_sources(resp_dict: dict[str, Any]) -> list[dict[str, str]]:
         seen.add(url)
         collected.append(parsed)
 
-    output = resp_dict.get("output") or []
-
-    # Preferred source: included web_search_call.action.sources.
-    for item in output:
-        if not isinstance(item, dict):
-            continue
-        if item.get("type") != "web_search_call":
-            continue
-        action = item.get("action") or {}
-        if not isinstance(action, dict):
-            continue
-        sources = action.get("sources") or []
-        if isinstance(sources, list):
-            for src in sources:
-                if isinstance(src, dict):
-                    add(src)
-
-    # Fallback source: URL citations inside assistant message annotations.
-    for item in output:
-        if not isinstance(item, dict):
-            continue
-        if item.get("type") != "message":
-            continue
-        content = item.get("content") or []
-        for part in content:
-            if not isinstance(part, dict):
-                continue
-            annotations = part.get("annotations") or []
-            if not isinstance(annotations, list):
-                continue
-            for ann in annotations:
-                if not isinstance(ann, dict):
-                    continue
-                add(ann)
+    # Сначала web_search_call.action.sources, затем URL-цитаты из аннотаций ответа.
+    for src in call_sources:
+        add(src)
+    for ann in annotations:
+        add(ann)
 
     # Last resort: scan any top-level URL-like values.
     if not collected:
@@ -190,15 +189,14 @@ def _extract_sources(resp_dict: dict[str, Any]) -> list[dict[str, str]]:
 
         walk(resp_dict)
 
-    return collected
+    return answer_text, search_query or fallback_query, collected
 
 
 def _extract_links_from_text(text: str) -> list[dict[str, str]]:
-    links = re.findall(r"https?://[^\s\])>]+", text or "")
     out: list[dict[str, str]] = []
     seen: set[str] = set()
-    for url in links:
-        clean = _safe_text(url.rstrip(".,;!?:"))
+    for match in _URL_RE.finditer(text or ""):
+        clean = _safe_text(match.group().rstrip(".,;!?:"))
         if not clean or clean in seen:
             continue
         seen.add(clean)
@@ -206,6 +204,7 @@ def _extract_links_from_text(text: str) -> list[dict[str, str]]:
     return out
 
 
+@functools.lru_cache(maxsize=4096)
 def _normalize_query_for_wine(query: str) -> str:
     q = _safe_text(query)
     if not q:
@@ -230,42 +229,79 @@ def _normalize_query_for_wine(query: str) -> str:
 
 
 def _tokenize(value: str) -> list[str]:
-    return [t for t in re.findall(r"[0-9a-zа-яё]+", (value or "").lower()) if len(t) >= 3]
-
-
-def _source_score(query: str, item: dict[str, str]) -> int:
-    hay = " ".join(
-        [
-            _safe_text(item.get("title")),
-            _safe_text(item.get("snippet")),
-            _safe_text(item.get("url")),
-        ]
-    ).lower()
-    score = 0
-    for marker in WINE_MARKERS:
-        if marker in hay:
-            score += 3
-    for marker in NON_WINE_MARKERS:
-        if marker in hay:
-            score -= 8
-    for tok in _tokenize(query):
-        if tok in hay:
-            score += 1
+    return [t for t in _TOKEN_RE.findall((value or "").lower()) if len(t) >= 3]
+
+
+def _source_score(query_tokens: Sequence[str], item: dict[str, str]) -> int:
+    # Поля источника уже нормализованы в _parse_source_item/_extract_links_from_text.
+    hay = f"{item['title']} {item['snippet']} {item['url']}".lower()
+    # Маркеры могут пересекаться (vin/vino, wine/winestyle): каждый считается отдельно,
+    # поэтому остается проверка подстрокой по каждому, а не одна регулярка-альтернация.
+    score = 3 * sum(marker in hay for marker in WINE_MARKERS)
+    score -= 8 * sum(marker in hay for marker in NON_WINE_MARKERS)
+    score += sum(tok in hay for tok in query_tokens)
     return score
 
 
 def _rank_sources(query: str, items: list[dict[str, str]], limit: int) -> list[dict[str, str]]:
     if not items:
         return []
-    scored = sorted(
-        [(_source_score(query, item), item) for item in items],
-        key=lambda t: t[0],
-        reverse=True,
+    # Запрос токенизируется один раз на все источники.
+    query_tokens = _tokenize(query)
+    # nlargest равен sorted(..., reverse=True)[:limit] с тем же порядком равных оценок.
+    # Оба фильтра отсекают хвост по убыванию оценки, поэтому достаточно top-K.
+    top = heapq.nlargest(
+        limit,
+        ((_source_score(query_tokens, item), item) for item in items),
+        key=itemgetter(0),
     )
-    filtered = [item for score, item in scored if score >= 2][:limit]
+    filtered = [item for score, item in top if score >= 2]
     if filtered:
         return filtered
-    return [item for score, item in scored if score > -8][:limit]
+    return [item for score, item in top if score > -8]
+
+
+# Клиент OpenAI (пул соединений, TLS) и описание web-инструмента создаются один раз
+# на набор настроек, а не на каждый поиск; смена переменных окружения дает новый ключ кэша.
+@functools.lru_cache(maxsize=4)
+def _get_client(api_key: str) -> Any:
+    return OpenAI(api_key=api_key)
+
+
+@functools.lru_cache(maxsize=16)
+def _build_web_tool(
+    context_size_raw: str,
+    country_raw: str,
+    city_raw: str,
+    allowed_domains_raw: str,
+) -> dict[str, Any]:
+    context_size = _safe_text(context_size_raw).lower()
+    if context_size not in {"low", "medium", "high"}:
+        context_size = "medium"
+
+    country = _safe_text(country_raw).upper()
+    city = _safe_text(city_raw)
+
+    web_tool: dict[str, Any] = {
+        "type": "web_search",
+        "search_context_size": context_size,
+    }
+    if country:
+        user_location: dict[str, Any] = {
+            "type": "approximate",
+            "country": country,
+        }
+        if city:
+            user_location["city"] = city
+        web_tool["user_location"] = user_location
+
+    filters: dict[str, Any] = {}
+    domains = [domain for domain in (_safe_text(item) for item in allowed_domains_raw.split(",")) if domain]
+    if domains:
+        filters["allowed_domains"] = domains
+    if filters:
+        web_tool["filters"] = filters
+    return web_tool
 
 
 def search_wine_web(query: str, max_results: int = 5) -> dict[str, Any]:
@@ -294,39 +330,13 @@ def search_wine_web(query: str, max_results: int = 5) -> dict[str, Any]:
 
     max_results = max(1, min(int(max_results or 5), 10))
     web_model = _safe_text(os.getenv("OPENAI_WEB_MODEL") or os.getenv("OPENAI_MODEL") or "gpt-4.1")
-    context_size = _safe_text(os.getenv("WEB_SEARCH_CONTEXT_SIZE") or "medium").lower()
-    if context_size not in {"low", "medium", "high"}:
-        context_size = "medium"
-
-    country = _safe_text(os.getenv("WEB_SEARCH_COUNTRY") or "RU").upper()
-    city = _safe_text(os.getenv("WEB_SEARCH_CITY") or "moscow")
-
-    web_tool: dict[str, Any] = {
-        "type": "web_search",
-        "search_context_size": context_size,
-    }
-    if country:
-        user_location: dict[str, Any] = {
-            "type": "approximate",
-            "country": country,
-        }
-        if city:
-            user_location["city"] = city
-        web_tool["user_location"] = user_location
-
-    client = OpenAI(api_key=api_key)
-    allowed_domains_raw = _safe_text(os.getenv("WEB_SEARCH_ALLOWED_DOMAINS"))
-    filters: dict[str, Any] = {}
-    if allowed_domains_raw:
-        domains = [
-            _safe_text(item)
-            for item in allowed_domains_raw.split(",")
-            if _safe_text(item)
-        ]
-        if domains:
-            filters["allowed_domains"] = domains
-    if filters:
-        web_tool["filters"] = filters
+    web_tool = _build_web_tool(
+        os.getenv("WEB_SEARCH_CONTEXT_SIZE") or "medium",
+        os.getenv("WEB_SEARCH_COUNTRY") or "RU",
+        os.getenv("WEB_SEARCH_CITY") or "moscow",
+        os.getenv("WEB_SEARCH_ALLOWED_DOMAINS") or "",
+    )
+    client = _get_client(api_key)
 
     normalized_query = _normalize_query_for_wine(q)
 
@@ -370,11 +380,8 @@ def search_wine_web(query: str, max_results: int = 5) -> dict[str, Any]:
             "engine": "openai_web_search",
         }
 
-    resp_dict_any = _to_dict(response)
-    resp_dict = resp_dict_any if isinstance(resp_dict_any, dict) else {}
-    search_query = _extract_search_query(resp_dict, q)
-    answer_text = _extract_message_text(response, resp_dict)
-    sources = _extract_sources(resp_dict)
+    resp_dict = _response_to_dict(response)
+    answer_text, search_query, sources = _extract_response_parts(response, resp_dict, q)
 
     if not sources and answer_text:
         sources = _extract_links_from_text(answer_text)